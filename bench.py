@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the parse and match hot paths.
+
+    python bench.py                         # run everything, print JSON
+    python bench.py -o new.json -b old.json # save results, compare to a baseline
+    python bench.py -k parse --quick        # just the parse benchmarks, smaller
+
+The corpora are generated from a seeded random.Random so every run (and
+every machine) sees the same queries and documents.  Each benchmark runs in
+its own process so its peak memory (max RSS) isn't inflated by the ones
+before it, and is run a few times with the fastest run kept.  Results are
+JSON: per benchmark the number of operations, the throughput, the 50/90/99th
+percentile latency of one operation and the peak memory.
+"""
+
+import sys
+import json
+import random
+import resource
+import platform
+import optparse
+import multiprocessing
+from timeit import default_timer
+
+import boolmatch
+
+ASCII = ['cloud', 'computing', 'security', 'trends', 'forecast', 'technology', 'market', 'data',
+         'analytics', 'mobile', 'network', 'storage', 'revenue', 'growth', 'startup', 'platform',
+         'x&y', 'r&d', 'c++', '.net', "boar's", 'at&t', '999', '2012']
+UNICODE = [u'caf\xe9', u'na\xefve', u'\u6c49\u8bed', u'\u6f22', u'\u0434\u0430\u043d\u043d\u044b\u0435',
+           u'\u03b1\u03b2\u03b3', u'stra\xdfe', u'\xfcber']
+SEPARATORS = [' '] * 12 + [', ', '. ', '\n', ' - ', '; ', '! ']
+
+class Corpus(object):
+    """ seeded synthetic queries and documents """
+    def __init__(self, seed, vocab_size):
+        self.random = random.Random(seed)
+        filler = ['w%d' % i for i in xrange(vocab_size)]
+        self.words = ASCII + filler
+        self.unicode_words = UNICODE + ASCII + filler
+
+    def word(self, words=None):
+        # a few words are common and most are rare, like real text
+        words = words or self.words
+        return words[min(int(self.random.paretovariate(1.0)) - 1, len(words) - 1)]
+
+    def document(self, n, words=None):
+        return u''.join(self.word(words) + self.random.choice(SEPARATORS) for _ in xrange(n))
+
+    def term(self, wildcards=0.05, phrases=0.1, words=None):
+        r = self.random.random()
+        if r < wildcards:
+            return self.word(words)[:4] + '*'
+        if r < wildcards + phrases:
+            return u'"%s %s"' % (self.word(words), self.word(words))
+        return self.word(words)
+
+    def query(self, n, depth=1, **kwargs):
+        """ n terms mixing AND, OR and NOT, nested up to depth parens deep """
+        parts = []
+        for i in xrange(n):
+            term = self.term(**kwargs)
+            if self.random.random() < 0.1:
+                term = 'NOT ' + term
+            parts.append(term)
+            parts.append(self.random.choice(['AND', 'OR', 'OR', '']))
+        query = ' '.join(parts[:-1])
+        for i in xrange(depth - 1):
+            query = '(%s) %s %s' % (query, self.random.choice(['AND', 'OR']), self.term(**kwargs))
+        return query
+
+def needs(*names):
+    """ mark a benchmark as needing these boolmatch attributes, 'Class.method'
+        for a method, so it's skipped against versions without them
+    """
+    def mark(func):
+        func.needs = names
+        return func
+    return mark
+
+def missing(func):
+    """ the attributes a benchmark needs that boolmatch doesn't have """
+    absent = []
+    for name in getattr(func, 'needs', ()):
+        obj = boolmatch
+        for attr in name.split('.'):
+            obj = getattr(obj, attr, None)
+        if obj is None:
+            absent.append(name)
+    return absent
+
+def _parse(queries):
+    return [lambda query=query: boolmatch.make_parse_tree(query) for query in queries]
+
+def _match(trees, documents):
+    return [lambda tree=tree, doc=doc: tree.matches(doc) for tree in trees for doc in documents]
+
+def bench_parse_tiny(corpus, scale):
+    return _parse([corpus.query(2) for _ in xrange(2000 * scale)])
+
+def bench_parse_medium(corpus, scale):
+    return _parse([corpus.query(20, depth=3) for _ in xrange(200 * scale)])
+
+def bench_parse_huge(corpus, scale):
+    return _parse([corpus.query(2000, depth=200) for _ in xrange(2 * scale)])
+
+def bench_tokenize_medium(corpus, scale):
+    queries = [corpus.query(20) for _ in xrange(200 * scale)]
+    return [lambda query=query: boolmatch.tokenize(query) for query in queries]
+
+def bench_match_short(corpus, scale):
+    trees = [boolmatch.make_parse_tree(corpus.query(10, depth=2)) for _ in xrange(20)]
+    return _match(trees, [corpus.document(20) for _ in xrange(50 * scale)])
+
+def bench_match_long(corpus, scale):
+    trees = [boolmatch.make_parse_tree(corpus.query(10, depth=2)) for _ in xrange(10)]
+    return _match(trees, [corpus.document(20000) for _ in xrange(scale)])
+
+def bench_matches_cached(corpus, scale):
+    # the module level matches(): cache lookup and lowercasing included
+    queries = [corpus.query(5) for _ in xrange(50)]
+    documents = [corpus.document(50) for _ in xrange(20 * scale)]
+    return [lambda q=q, d=d: boolmatch.matches(q, d) for q in queries for d in documents]
+
+def bench_wildcards(corpus, scale):
+    trees = [boolmatch.make_parse_tree(corpus.query(10, wildcards=0.6)) for _ in xrange(20)]
+    return _match(trees, [corpus.document(500) for _ in xrange(10 * scale)])
+
+def bench_phrases(corpus, scale):
+    trees = [boolmatch.make_parse_tree(corpus.query(10, phrases=0.7)) for _ in xrange(20)]
+    return _match(trees, [corpus.document(500) for _ in xrange(10 * scale)])
+
+def bench_unicode(corpus, scale):
+    words = corpus.unicode_words
+    trees = [boolmatch.make_parse_tree(corpus.query(10, words=words)) for _ in xrange(20)]
+    return _match(trees, [corpus.document(500, words) for _ in xrange(10 * scale)])
+
+@needs('PatternSet')
+def bench_pattern_set(corpus, scale):
+    # many queries x many documents, one PatternSet.match() per document
+    patterns = boolmatch.PatternSet((i, corpus.query(5)) for i in xrange(1000))
+    return [lambda doc=doc: patterns.match(doc) for doc in [corpus.document(200) for _ in xrange(50 * scale)]]
+
+@needs('PatternSet.match_matrix')
+def bench_pattern_set_batch(corpus, scale):
+    # the same workload as bench_pattern_set, 50 documents per match_matrix()
+    patterns = boolmatch.PatternSet((i, corpus.query(5)) for i in xrange(1000))
+    documents = [corpus.document(200) for _ in xrange(50 * scale)]
+    batches = [documents[i:i+50] for i in xrange(0, len(documents), 50)]
+    return [lambda batch=batch: patterns.match_matrix(batch) for batch in batches]
+
+def bench_many_trees(corpus, scale):
+    # the same workload as bench_pattern_set with one tree per query
+    trees = [boolmatch.make_parse_tree(corpus.query(5)) for i in xrange(1000)]
+    documents = [corpus.document(200) for _ in xrange(2 * scale)]
+    return [lambda doc=doc: [tree.matches(doc) for tree in trees] for doc in documents]
+
+@needs('matches_stream')
+def bench_stream(corpus, scale):
+    trees = [boolmatch.make_parse_tree(corpus.query(5)) for _ in xrange(5)]
+    documents = [corpus.document(20000) for _ in xrange(scale)]
+    def stream(tree, doc):
+        return boolmatch.matches_stream(tree, (doc[i:i+4096] for i in xrange(0, len(doc), 4096)))
+    return [lambda tree=tree, doc=doc: stream(tree, doc) for tree in trees for doc in documents]
+
+BENCHMARKS = sorted((name[len('bench_'):], func) for name, func in globals().items()
+                    if name.startswith('bench_'))
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def run(name, seed, scale):
+    """ run one benchmark (in a fresh process) and return its results """
+    corpus = Corpus(seed, vocab_size=5000)
+    ops = dict(BENCHMARKS)[name](corpus, scale)
+    if hasattr(boolmatch, 'tree_cache'):
+        boolmatch.tree_cache.clear()
+    latencies = []
+    start = default_timer()
+    for op in ops:
+        t = default_timer()
+        op()
+        latencies.append(default_timer() - t)
+    total = default_timer() - start
+    latencies.sort()
+    return {
+        'ops': len(ops),
+        'seconds': total,
+        'ops_per_sec': len(ops) / total if total else None,
+        'p50_us': percentile(latencies, 0.50) * 1e6,
+        'p90_us': percentile(latencies, 0.90) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def _run(args):
+    return run(*args)
+
+def compare(results, baseline):
+    """ print how each benchmark changed against the baseline results """
+    print >>sys.stderr, '%-18s %12s %12s %8s %10s' % ('benchmark', 'base ops/s', 'ops/s', 'change', 'p99 change')
+    for name, new in sorted(results['benchmarks'].items()):
+        old = baseline.get('benchmarks', {}).get(name)
+        if not old:
+            print >>sys.stderr, '%-18s %12s %12.1f' % (name, '-', new['ops_per_sec'])
+            continue
+        change = (new['ops_per_sec'] / old['ops_per_sec'] - 1) * 100
+        p99 = (new['p99_us'] / old['p99_us'] - 1) * 100
+        print >>sys.stderr, '%-18s %12.1f %12.1f %+7.1f%% %+9.1f%%' % (
+            name, old['ops_per_sec'], new['ops_per_sec'], change, p99)
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-k', dest='match', default='', help='only run benchmarks with this in their name')
+    parser.add_option('-s', '--seed', type='int', default=1, help='corpus seed [%default]')
+    parser.add_option('--scale', type='int', default=5, help='workload size multiplier [%default]')
+    parser.add_option('--quick', action='store_const', const=1, dest='scale', help='the same as --scale=1')
+    parser.add_option('-r', '--repeat', type='int', default=3, help='runs of each benchmark, the fastest is kept [%default]')
+    parser.add_option('-o', '--output', help='write the JSON results here instead of stdout')
+    parser.add_option('-b', '--baseline', help='compare against the JSON results of an earlier run')
+    parser.add_option('-l', '--list', action='store_true', help='list the benchmarks and exit')
+    options, args = parser.parse_args(argv)
+    names = [name for name, func in BENCHMARKS if options.match in name]
+    if options.list:
+        print '\n'.join(names)
+        return
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': options.seed,
+        'scale': options.scale,
+        'repeat': options.repeat,
+        'benchmarks': {},
+    }
+    for name in names:
+        absent = missing(dict(BENCHMARKS)[name])
+        if absent:
+            print >>sys.stderr, '%-18s skipped, boolmatch has no %s' % (name, ', '.join(absent))
+            continue
+        runs = []
+        for i in xrange(options.repeat):
+            pool = multiprocessing.Pool(1)
+            try:
+                runs.append(pool.apply(_run, ((name, options.seed, options.scale),)))
+            finally:
+                pool.terminate()
+                pool.join()
+        results['benchmarks'][name] = max(runs, key=lambda result: result['ops_per_sec'])
+        print >>sys.stderr, '%-18s %10.1f ops/s' % (name, results['benchmarks'][name]['ops_per_sec'])
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    if options.baseline:
+        with open(options.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,109 +4,149 @@ Written by Jack Diederich (jackdied@gmail.com)
 """
 
 import re
+import sys
+import mmap
+import struct
 import itertools as it
+import threading
+import Queue
+import multiprocessing
+import weakref
+from array import array
+from bisect import bisect_left
+from timeit import default_timer
+from collections import OrderedDict, namedtuple, deque
 
 class ParseException(Exception):  # minimally compatible with pyparsing.ParseException
     def __init__(self, msg, loc=0):
         self.msg = msg
         self.loc = loc
 
+class BudgetExceeded(Exception):
+    """ matching ran out of the time or steps in its Budget """
+
 class _tagstr(unicode):
+    __slots__ = ('lineno', 'char')
+
+    @property
+    def txt(self):
+        return unicode(self)
+
     def pretty(self):
         return '<_tagstr %r lineno=%d char=%d>' % (self.txt, self.lineno, self.char)
 
+    def __reduce__(self):
+        return tagstr, (unicode(self), self.lineno, self.char)
+
 def tagstr(txt=None, lineno=0, char=0):
-    if txt is None:
-        val = _tagstr()
-        val.txt = ''
-    else:
-        val = _tagstr(txt)
-        val.txt = txt
+    val = _tagstr() if txt is None else _tagstr(txt)
     val.lineno = lineno
     val.char = char
     return val
 
-def _tokenize(text):
-    """ break the string into tokens of words, quoted strings, and parens """
-    parts = []
-    stack = [None]
-    stack_i = [None]
-    lineno = getattr(text, 'lineno', 0)
-    char = getattr(text, 'char', 0)
+WORD, OPEN, CLOSE = range(3)
 
-    curr = tagstr(lineno=lineno, char=char)
-    for i, c in enumerate(text):
-        if c == '\n':
-            lineno += 1
-        if c.isspace() and stack[-1] is None:
-            parts.append(curr)
-            curr = tagstr(u'', lineno=lineno, char=char+i+1)
-            continue
-        elif c == '(' and stack[-1] is None and curr:
-            parts.append(curr)
-            curr = tagstr(u'', lineno=lineno, char=char+i+1)
+class Lexeme(object):
+    """ a word (quoted parts included) or a paren, and where it starts """
+    __slots__ = ('kind', 'text', 'lineno', 'char')
+
+    def __init__(self, kind, text, lineno, char):
+        self.kind = kind
+        self.text = text
+        self.lineno = lineno
+        self.char = char
 
-        curr = tagstr(curr + c, lineno=curr.lineno, char=curr.char)
-        if c not in '()"':
+    def __repr__(self):
+        return '<Lexeme %r (%d, %d)>' % (self.text, self.lineno, self.char)
+
+    def __reduce__(self):
+        return Lexeme, (self.kind, self.text, self.lineno, self.char)
+
+# whitespace, open paren, close paren, a word, or a quote that is never closed
+_lexeme_re = re.compile(r'(\s+)|(\()|(\))|((?:[^\s()"]+|"[^"]*")+)|(")', re.U)
+
+def _lex(text, start=0, end=None):
+    """ split text, from start on and up to end, into Lexemes in a single pass.
+        Raises the same ParseExceptions as _tokenize.
+    """
+    lineno = getattr(text, 'lineno', 0) + text.count('\n', 0, start)
+    char = getattr(text, 'char', 0)
+    opens = [] # offsets of the unclosed parens
+    last = start
+    for m in _lexeme_re.finditer(text, start, len(text) if end is None else end):
+        kind = m.lastindex
+        if kind == 1:
             continue
-        if stack[-1] == '"': # waiting for a closing quote
-            if c == '"':
-                stack.pop()
-                stack_i.pop()
-        elif c == '"':
-            stack.append(c)
-            stack_i.append(i)
+        i = m.start()
+        lineno += text.count('\n', last, i)
+        last = i
+        if kind == 4:
+            yield Lexeme(WORD, m.group(), lineno, char+i)
+        elif kind == 2:
+            opens.append(i)
+            yield Lexeme(OPEN, '(', lineno, char+i)
+        elif kind == 3:
+            if not opens:
+                raise ParseException("mismatched closing parenthesis at character %d" % i, loc=i)
+            opens.pop()
+            yield Lexeme(CLOSE, ')', lineno, char+i)
         else:
-            if c == '(':
-                stack.append('(')
-                stack_i.append(i)
-            elif c == ')':
-                if stack[-1] != '(':
-                    raise ParseException("mismatched closing parenthesis at character %d" % i, loc=i)
-                stack.pop()
-                stack_i.pop()
-                if stack[-1] is None:
-                    parts.append(curr)
-                    curr = tagstr(u'', lineno=lineno, char=char+i+1)
-            else:
-                raise ParseException("bad parse")
-    if curr:
-        parts.append(curr)
-    if stack[-1] is not None:
-        if stack[-1] == '"':
-            raise ParseException("mismatched quotes starting at character %d" % stack_i[-1], loc=stack_i[-1])
-        elif stack[-1] == '(':
-            raise ParseException("mismatched parenthesis starting at character %d" % stack_i[-1], loc=stack_i[-1])
-        else:
-            raise ParseException("bad parse")
+            raise ParseException("mismatched quotes starting at character %d" % i, loc=i)
+    if opens:
+        raise ParseException("mismatched parenthesis starting at character %d" % opens[-1], loc=opens[-1])
 
-    return filter(None, parts)
+def _tokenize(text):
+    """ break the string into tokens of words, quoted strings, and parens """
+    parts = []
+    depth = 0
+    for lexeme in _lex(text):
+        if lexeme.kind == OPEN:
+            if not depth:
+                group = lexeme
+            depth += 1
+        elif lexeme.kind == CLOSE:
+            depth -= 1
+            if not depth:
+                start = group.char - getattr(text, 'char', 0)
+                end = lexeme.char - getattr(text, 'char', 0) + 1
+                parts.append(tagstr(text[start:end], lineno=group.lineno, char=group.char))
+        elif not depth:
+            parts.append(tagstr(lexeme.text, lineno=lexeme.lineno, char=lexeme.char))
+    return parts
 
 def combine_nots(chunks):
     parts = []
-    while chunks:
-        top = chunks.pop(0)
+    i = 0
+    while i < len(chunks):
+        top = chunks[i]
         if top.upper() == 'NOT':
-            if not chunks:
+            if i + 1 == len(chunks):
                 raise ParseException("trailing NOT on line %d" % top.lineno)
-            parts.append(tagstr(u'NOT %s' % chunks.pop(0), lineno=top.lineno, char=top.char))
+            parts.append(tagstr(u'NOT %s' % chunks[i+1], lineno=top.lineno, char=top.char))
+            i += 2
         else:
             parts.append(top)
+            i += 1
     return parts
 
 def combine_ors(chunks):
-    parts = []
-    while chunks:
-        top = chunks.pop(0)
+    groups = []
+    i = 0
+    while i < len(chunks):
+        top = chunks[i]
         if top.upper() == 'OR':
-            if not chunks:
+            if i + 1 == len(chunks):
                 raise ParseException("bare OR at beginning of terms")
-            if not parts:
+            if not groups:
                 raise ParseException("bare OR at end of terms line %d" % top.lineno)
-            parts[-1] = tagstr(u'%s OR %s' % (parts[-1], chunks.pop(0)), lineno=parts[-1].lineno, char=parts[-1].char)
+            groups[-1].append(chunks[i+1])
+            i += 2
         else:
-            parts.append(top)
-    return parts
+            groups.append([top])
+            i += 1
+    return [(group[0] if len(group) == 1 else
+             tagstr(u' OR '.join(group), lineno=group[0].lineno, char=group[0].char))
+            for group in groups]
 
 def tokenize(text):
     toks = combine_nots(_tokenize(text))
@@ -132,27 +172,167 @@ def tokenize(text):
     parts.pop()
     return parts
 
-class AND(object):
-    word = 'AND'
+_tree_edits = [0] # how many times any tree has been changed by hand
+
+class _Parts(list):
+    """ the parts of an AND or OR, which count the times they are changed in place """
+    __slots__ = ('version',)
+
+    def __init__(self, parts=()):
+        list.__init__(self, parts)
+        self.version = 0
+
+    def _flattened(self, parts):
+        # flattening never changes what matches, so it isn't an edit
+        list.__setitem__(self, slice(None), parts)
+
+def _editing(name):
+    method = getattr(list, name)
+    def editing(self, *args):
+        self.version += 1
+        _tree_edits[0] += 1
+        return method(self, *args)
+    editing.__name__ = name
+    return editing
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__', '__imul__',
+              'append', 'extend', 'insert', 'pop', 'remove', 'reverse', 'sort'):
+    setattr(_Parts, _name, _editing(_name))
+
+class Node(object):
+    """ base of the AND/OR/NOT tree nodes.  The tree is compiled to a Program
+        the first time it is evaluated, and compiled again the next time
+        after the parts of one of its ANDs or ORs, or the tree of one of
+        its NOTs, have been changed by hand.
+        Evaluating never changes the tree so one tree can be shared between
+        threads, use trace() to see how each node evaluated.
+    """
+    __slots__ = ('profile', '_program', '_traced', '_version', '_checked')
     last = '?'
 
+    def __init__(self):
+        self.profile = None # a QueryProfile to record every match in
+        self._program = self._traced = None
+        self._version = 0 # how many times its parts or tree have been set by hand
+        self._checked = _tree_edits[0] # no tree has been edited since its Programs were checked
+
+    def _check(self):
+        # an edit to any tree means looking at the nodes this one was
+        # compiled from, only a change to one of them means compiling again
+        edits = _tree_edits[0]
+        if self._program is not None and not self._program.current():
+            self._program = None
+        if self._traced is not None and not self._traced.current():
+            self._traced = None
+        self._checked = edits
+
+    def compile(self):
+        if self._checked != _tree_edits[0]:
+            self._check()
+        if self._program is None:
+            self._program = Program(self)
+        return self._program
+
+    def matches(self, text, budget=None):
+        """ does text match, within budget if there is one.  See Budget. """
+        if self.profile is None:
+            return self.compile().matches(text, budget)
+        return self.profile.matches(self, text, budget)
+
+    def evaluate(self, term_matches):
+        """ evaluate the tree with term_matches(token) deciding each leaf """
+        return self.compile().evaluate(term_matches)
+
+    def trace(self, text):
+        """ match text and return a Trace of what every node evaluated to """
+        fold = _Fold(text)
+        return self._trace(lambda leaf: _leaf_matches(leaf, text, None, fold))
+
+    def _trace(self, term_matches):
+        if self._checked != _tree_edits[0]:
+            self._check()
+        if self._traced is None:
+            self._traced = Program(self, traced=True)
+        trace = Trace(self._traced)
+        trace.result = self._traced.evaluate(term_matches, trace.values)
+        return trace
+
+    def explain(self, text):
+        """ match text and return its Trace with trace.hits set to a
+            (token, spans) pair for every token that made the match true.
+            Each term is scanned once for its spans and the evaluation
+            short-circuits as usual, so ORs stop at the first true part.
+            Tokens under a NOT never contribute.
+        """
+        spans = {}
+        fold = _Fold(text)
+        def term_matches(leaf):
+            found = spans[id(leaf)] = leaf.term.spans(text, fold)
+            return bool(found)
+        trace = self._trace(term_matches)
+        if trace.result:
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                if isinstance(node, AND):
+                    stack.extend(part for part in reversed(node.parts) if trace[part] is True)
+                elif isinstance(node, Token):
+                    trace.hits.append((node, spans[id(node)]))
+        return trace
+
+    def find_matches(self, text):
+        """ the sorted (start, end, token) of every hit that made text
+            match, empty if it didn't match.  See explain().
+        """
+        return sorted(((beg, end, token) for token, spans in self.explain(text).hits
+                       for beg, end in spans), key=lambda hit: hit[:2])
+
+    def flatten(self):
+        for node in postorder(self):
+            if isinstance(node, Node):
+                node._flatten()
+
+    def pretty(self):
+        self.flatten()
+        strings = []
+        for node in postorder(self):
+            if isinstance(node, Node):
+                n = len(children(node))
+                node_strings = strings[len(strings)-n:]
+                del strings[len(strings)-n:]
+                strings.append(node._pretty(node_strings))
+            else:
+                strings.append(node.pretty())
+        return strings[0]
+
+class AND(Node):
+    __slots__ = ('_parts',)
+    word = 'AND'
+
     def __init__(self, parts=None):
-        self.parts = parts or []
+        Node.__init__(self)
+        self._parts = _Parts(parts or [])
 
-    def matches(self, text):
-        for part in self.parts:
-            if not part.matches(text):
-                self.last = False
-                return False
-        self.last = True
-        return True
+    @property
+    def parts(self):
+        return self._parts
+
+    @parts.setter
+    def parts(self, parts):
+        self._version += 1
+        _tree_edits[0] += 1
+        self._parts = _Parts(parts)
+
+    def _stamp(self):
+        return self._version, self._parts.version
+
+    def __reduce__(self):
+        return self.__class__, (list(self._parts),)
 
     def __repr__(self):
         return '<AND %s %s>' % (self.parts, self.last)
 
-    def flatten(self):
-        for child in self.parts:
-            val = getattr(child, 'flatten', int)()
+    def _flatten(self):
         newparts = []
         for child in self.parts:
             if child.__class__ == self.__class__:
@@ -161,49 +341,419 @@ class AND(object):
                 newparts.append(child.parts[0])
             else:
                 newparts.append(child)
-        self.parts = newparts
-        return
+        self._parts._flattened(newparts)
 
-    def pretty(self):
-        self.flatten()
+    def _pretty(self, strings):
         word = ' ' + self.word + ' '
-        if len(self.parts) > 1:
-            return '(%s)' % word.join(part.pretty() for part in self.parts)
-        return self.word + ' ' + self.parts[0].pretty()
+        if len(strings) > 1:
+            return '(%s)' % word.join(strings)
+        if not strings:
+            return '()'
+        return self.word + ' ' + strings[0]
 
 class OR(AND):
+    __slots__ = ()
     word = 'OR'
 
-    def matches(self, text):
-        for part in self.parts:
-            if part.matches(text):
-                self.last = True
-                return True
-        self.last = False
-        return False
-
     def __repr__(self):
         return '<OR %s %s>' % (self.parts, self.last)
 
-class NOT(object):
+class NOT(Node):
+    __slots__ = ('_tree',)
     word = 'NOT'
-    last = '?'
 
     def __init__(self, tree):
-        self.tree = tree
+        Node.__init__(self)
+        self._tree = tree
+
+    @property
+    def tree(self):
+        return self._tree
+
+    @tree.setter
+    def tree(self, tree):
+        self._version += 1
+        _tree_edits[0] += 1
+        self._tree = tree
 
-    def matches(self, text):
-        return not self.tree.matches(text)
+    def _stamp(self):
+        return self._version
+
+    def __reduce__(self):
+        return NOT, (self._tree,)
 
     def __repr__(self):
         return '<NOT %s %s>' % (self.tree, self.last)
 
-    def flatten(self):
+    def _flatten(self):
         if isinstance(self.tree, AND) and len(self.tree.parts) == 1 and isinstance(self.tree.parts[0], Token):
-            self.tree = self.tree.parts[0]
+            self._tree = self.tree.parts[0]
 
-    def pretty(self):
-        return 'NOT %s' % self.tree.pretty()
+    def _pretty(self, strings):
+        return 'NOT %s' % strings[0]
+
+def children(node):
+    if isinstance(node, AND):
+        return node.parts
+    if isinstance(node, NOT):
+        return [node.tree]
+    return []
+
+def postorder(tree):
+    """ yield every node in tree, children before their parents """
+    stack = [(tree, False)]
+    while stack:
+        node, expanded = stack.pop()
+        kids = children(node)
+        if expanded or not kids:
+            yield node
+        else:
+            stack.append((node, True))
+            stack.extend((kid, False) for kid in reversed(kids))
+
+def _evaluate(node, term_matches):
+    if isinstance(node, Node):
+        return node.evaluate(term_matches)
+    return term_matches(node)
+
+class Trace(object):
+    """ the value every node of a tree evaluated to for one text.
+        trace[node] is True or False, or '?' if evaluation never got there.
+    """
+    def __init__(self, program):
+        self.program = program # keeps the nodes, and so their ids, alive
+        self.values = {}
+        self.result = None
+        self.hits = [] # filled in by Node.explain()
+
+    def __getitem__(self, node):
+        return self.values.get(id(node), '?')
+
+class TokenProfile(object):
+    """ what one leaf of a profiled tree cost """
+    def __init__(self, token):
+        self.token = token
+        self.evaluations = 0
+        self.hits = 0
+        self.seconds = 0.0
+        self.short_circuits = 0 # matches that never had to look at it
+
+    @property
+    def hit_rate(self):
+        return float(self.hits) / self.evaluations if self.evaluations else 0.0
+
+    def __repr__(self):
+        return '<TokenProfile %r evaluations=%d hits=%d seconds=%.6f short_circuits=%d>' % (
+            self.token.string, self.evaluations, self.hits, self.seconds, self.short_circuits)
+
+class QueryProfile(object):
+    """ what matching one tree costs, turn it on with tree.profile = QueryProfile()
+        Only one match in every sample is recorded, the rest pay a counter.
+        callback(profile, text, result, seconds) is called after each
+        recorded match.  tokens has a TokenProfile for each leaf in
+        evaluation order; a leaf keeps its stats when the tree compiles
+        again, and they go away with it if it is edited out.
+    """
+    def __init__(self, sample=1, callback=None):
+        self.sample = sample
+        self.callback = callback
+        self.calls = 0
+        self.evaluations = 0
+        self.hits = 0
+        self.seconds = 0.0
+        self.short_circuits = 0 # matches that skipped at least one leaf
+        self.tokens = []
+        self.program = None
+        self.slots = {} # id(leaf) -> its index in tokens
+        self.lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        return float(self.hits) / self.evaluations if self.evaluations else 0.0
+
+    def matches(self, tree, text, budget=None):
+        program = tree.compile()
+        self.calls += 1
+        if self.calls % self.sample:
+            return program.matches(text, budget)
+        if budget is not None:
+            leaf_matches = _Prefixes(text, budget)
+        else:
+            fold = _Fold(text)
+            leaf_matches = lambda leaf: _leaf_matches(leaf, text, None, fold)
+        if program is not self.program: # new, or the tree was changed
+            with self.lock:
+                self.program = program
+                # keep the stats of leaves that are still in it
+                kept = dict((id(stats.token), stats) for stats in self.tokens)
+                self.tokens = [kept.get(id(leaf)) or TokenProfile(leaf) for leaf in program.leaves]
+                self.slots = dict((id(leaf), i) for i, leaf in enumerate(program.leaves))
+        tokens, slots = self.tokens, self.slots
+        times = [None] * len(tokens)
+        def term_matches(leaf):
+            start = default_timer()
+            hit = leaf_matches(leaf)
+            times[slots[id(leaf)]] = (hit, default_timer() - start)
+            return hit
+        start = default_timer()
+        result = program.evaluate(term_matches)
+        seconds = default_timer() - start
+        with self.lock:
+            self.evaluations += 1
+            self.hits += result
+            self.seconds += seconds
+            self.short_circuits += None in times
+            for stats, timed in it.izip(tokens, times):
+                if timed is None:
+                    stats.short_circuits += 1
+                else:
+                    stats.evaluations += 1
+                    stats.hits += timed[0]
+                    stats.seconds += timed[1]
+        if self.callback is not None:
+            self.callback(self, text, result, seconds)
+        return result
+
+    def __repr__(self):
+        return '<QueryProfile evaluations=%d hits=%d seconds=%.6f short_circuits=%d>' % (
+            self.evaluations, self.hits, self.seconds, self.short_circuits)
+
+class Profiler(object):
+    """ a QueryProfile for every pattern that goes through a TreeCache, see
+        TreeCache.set_profiler().  top(n) gives the n most expensive.
+    """
+    def __init__(self, sample=1, callback=None):
+        self.sample = sample
+        self.callback = callback
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def query(self, pattern):
+        with self.lock:
+            profile = self.queries.get(pattern)
+            if profile is None:
+                profile = self.queries[pattern] = QueryProfile(self.sample, self.callback)
+            return profile
+
+    def top(self, n=10):
+        """ the (pattern, QueryProfile) pairs that took the most time """
+        with self.lock:
+            queries = self.queries.items()
+        return sorted(queries, key=lambda item: item[1].seconds, reverse=True)[:n]
+
+OP_TERM, OP_NOT, OP_JUMP_FALSE, OP_JUMP_TRUE, OP_TRUE, OP_FALSE, OP_MARK = range(7)
+
+class Program(object):
+    """ a tree compiled to flat instructions that work on one boolean register.
+        ANDs and ORs short-circuit by jumping to their end, so evaluation is a
+        single loop with no recursion however deep the tree is.
+          OP_TERM i       register = term_matches(leaves[i])
+          OP_NOT          register = not register
+          OP_JUMP_FALSE t if not register: go to t
+          OP_JUMP_TRUE t  if register: go to t
+          OP_TRUE/FALSE   register = True/False (empty ANDs and ORs)
+          OP_MARK i       trace[id(nodes[i])] = register
+        OP_MARKs are only compiled in when traced is true.
+    """
+    __slots__ = ('ops', 'args', 'leaves', 'nodes', 'traced', 'wildcards', 'stamps')
+
+    def __init__(self, tree, traced=False):
+        self.ops, self.args, self.leaves, self.nodes = [], [], [], []
+        self.stamps = [] # (node, node._stamp()) for each AND, OR and NOT it was compiled from
+        self.traced = traced
+        ops, args = self.ops, self.args
+        stack = [[tree, 0, []]] # node, next child, jumps to patch to the node's end
+        while stack:
+            frame = stack[-1]
+            node, i, jumps = frame
+            if i == 0 and isinstance(node, Node):
+                self.stamps.append((node, node._stamp()))
+            if isinstance(node, NOT):
+                if i == 0:
+                    frame[1] = 1
+                    stack.append([node.tree, 0, []])
+                    continue
+                self._emit(OP_NOT)
+                self._mark(node)
+            elif isinstance(node, AND):
+                if not node.parts:
+                    self._emit(OP_FALSE if isinstance(node, OR) else OP_TRUE)
+                    self._mark(node)
+                elif i < len(node.parts):
+                    if i:
+                        jumps.append(len(ops))
+                        self._emit(OP_JUMP_TRUE if isinstance(node, OR) else OP_JUMP_FALSE, -1)
+                    frame[1] = i + 1
+                    stack.append([node.parts[i], 0, []])
+                    continue
+                else:
+                    for pc in jumps:
+                        args[pc] = len(ops)
+                    self._mark(node)
+            else:
+                self._emit(OP_TERM, len(self.leaves))
+                self.leaves.append(node)
+                self._mark(node)
+            stack.pop()
+        if not traced:
+            self._thread_jumps()
+        self.wildcards = sum(getattr(leaf, 'prefix', None) is not None for leaf in self.leaves)
+
+    def current(self):
+        """ is the tree still what it was when it was compiled """
+        for node, stamp in self.stamps:
+            if node._stamp() != stamp:
+                return False
+        return True
+
+    def _emit(self, op, arg=0):
+        self.ops.append(op)
+        self.args.append(arg)
+
+    def _mark(self, node):
+        if self.traced:
+            self._emit(OP_MARK, len(self.nodes))
+            self.nodes.append(node)
+
+    def _thread_jumps(self):
+        """ point jumps that land on another jump straight at the final target """
+        ops, args = self.ops, self.args
+        end = len(ops)
+        for pc in xrange(end):
+            op = ops[pc]
+            if op != OP_JUMP_FALSE and op != OP_JUMP_TRUE:
+                continue
+            target = args[pc]
+            while target < end:
+                if ops[target] == op: # same register, so it jumps too
+                    target = args[target]
+                elif ops[target] == OP_JUMP_FALSE or ops[target] == OP_JUMP_TRUE:
+                    target += 1 # the opposite jump is never taken
+                else:
+                    break
+            args[pc] = target
+
+    def __len__(self):
+        return len(self.ops)
+
+    def evaluate(self, term_matches, trace=None):
+        ops, args, leaves, nodes = self.ops, self.args, self.leaves, self.nodes
+        register = True
+        pc, end = 0, len(ops)
+        while pc < end:
+            op = ops[pc]
+            if op == OP_TERM:
+                register = term_matches(leaves[args[pc]])
+            elif op == OP_JUMP_FALSE:
+                if not register:
+                    pc = args[pc]
+                    continue
+            elif op == OP_JUMP_TRUE:
+                if register:
+                    pc = args[pc]
+                    continue
+            elif op == OP_MARK:
+                trace[id(nodes[args[pc]])] = register
+            elif op == OP_NOT:
+                register = not register
+            else:
+                register = op == OP_TRUE
+            pc += 1
+        return bool(register)
+
+    def matches(self, text, budget=None):
+        if self.wildcards < WILDCARD_INDEX_MIN and budget is None:
+            fold = _Fold(text)
+            return self.evaluate(lambda leaf: _leaf_matches(leaf, text, None, fold))
+        return self.evaluate(_Prefixes(text, budget))
+
+class Budget(object):
+    """ limits on matching, for tree.matches(text, budget) and the like.
+        seconds is a deadline counted from when the Budget is made, steps
+        is how many leaves may be evaluated and fallback candidates looked
+        at, and candidates is the most fallback candidates any one term may
+        look at in one text.  The exact match fallback of a term whose
+        regex missed checks every place the term occurs case sensitively,
+        which in some texts is a great many places.  Running out raises
+        BudgetExceeded.  Each call uses up what it spends, so one Budget can
+        bound a whole batch of calls.
+    """
+    __slots__ = ('deadline', 'steps', 'candidates')
+
+    def __init__(self, seconds=None, steps=None, candidates=None):
+        self.deadline = None if seconds is None else default_timer() + seconds
+        self.steps = steps
+        self.candidates = candidates
+
+    def step(self):
+        if self.steps is not None:
+            self.steps -= 1
+            if self.steps < 0:
+                raise BudgetExceeded("out of steps")
+        if self.deadline is not None and default_timer() > self.deadline:
+            raise BudgetExceeded("out of time")
+
+    def candidate(self, term, examined):
+        """ called for each fallback candidate, examined counts them for term """
+        if self.candidates is not None and examined > self.candidates:
+            raise BudgetExceeded("%r looked at more than %d candidates" % (term, self.candidates))
+        self.step()
+
+    def __repr__(self):
+        return '<Budget steps=%r candidates=%r>' % (self.steps, self.candidates)
+
+# trees with at least this many prefix* leaves look them up in a sorted
+# vocabulary of the text, which costs about as much as one regex scan
+WILDCARD_INDEX_MIN = 2
+
+class _Prefixes(object):
+    """ decides leaves (or terms) for one text.  Those with a prefix are
+        looked up in a sorted vocabulary of the text's words instead of each
+        scanning the text.  A regex that finds its prefix stops early, so
+        the vocabulary is only built once one of them has had to scan the
+        whole text and missed.
+        With a budget every leaf is a step.
+    """
+    __slots__ = ('text', 'vocab', 'missed', 'budget', 'fold')
+
+    def __init__(self, text, budget=None):
+        self.text = text
+        self.vocab = None
+        self.missed = False
+        self.budget = budget
+        self.fold = _Fold(text)
+
+    def _matches(self, leaf):
+        return _leaf_matches(leaf, self.text, self.budget, self.fold)
+
+    def __call__(self, leaf):
+        if self.budget is not None:
+            self.budget.step()
+        prefix = getattr(leaf, 'prefix', None)
+        if prefix is None:
+            return self._matches(leaf)
+        if self.vocab is None:
+            if not self.missed:
+                found = self._matches(leaf)
+                self.missed = not found
+                return found
+            # \w is ascii only so lowering the words is the same as re.I
+            self.vocab = sorted(set(word.lower() for word in set(_word_re.findall(self.text))))
+        vocab = self.vocab
+        i = bisect_left(vocab, prefix)
+        return i < len(vocab) and vocab[i].startswith(prefix)
+
+def _leaf_matches(leaf, text, budget, fold):
+    """ leaf.matches(text, budget), with fold for tokens and terms.  Leaves
+        made by hand may only take the text, or the text and a budget.
+    """
+    if leaf.__class__ is Token:
+        return leaf.term.matches(text, budget, fold)
+    if leaf.__class__ is Term:
+        return leaf.matches(text, budget, fold)
+    if budget is None:
+        return leaf.matches(text)
+    return leaf.matches(text, budget)
 
 def make_regexp_matching(word, left_anchor=None, right_anchor=None):
     """ make a regexp that will find word in a block of text.
@@ -221,31 +771,214 @@ def make_regex(text):
         return make_regexp_matching(text.rstrip('*'), right_anchor='')
     return make_regexp_matching(text)
 
-class Token(object):
-    last = '?'
+_word_re = re.compile(r'\w+') # ascii word characters, the \w the term regexes use
+_word_chars = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+# terms that start and end with a word character and are ascii in between
+_literal_re = re.compile(r'\w(?:[ -~]*\w)?\Z')
+
+# literal terms found inside other words this many times in one text go on
+# with the regex, whose scan rejects those without going back to Python
+LITERAL_MISSES = 8
+
+def _lower(text):
+    """ text with ascii case folded the way the term regexes ignore case,
+        or None if lowering it would turn other characters into ascii ones
+        too
+    """
+    if isinstance(text, unicode) and (u'\u0130' in text or u'\u212a' in text):
+        return None
+    return text.lower() # one character for one, non-ascii ones stay non-ascii
+
+class _Fold(object):
+    """ _lower(text) for the terms matched against one text, worked out
+        the first time one of them needs it so they fold it once between them
+    """
+    __slots__ = ('text', 'folded')
+
+    def __init__(self, text):
+        self.text = text
+        self.folded = self # until it's worked out
+
+    def __call__(self):
+        if self.folded is self:
+            self.folded = _lower(self.text)
+        return self.folded
+
+class Term(object):
+    """ the compiled matcher for one term string.  Terms are interned so every
+        Token with the same string (wildcard included) shares one.  The
+        regexes are compiled the first time they are used.
+        A wildcard term that is all word characters before the '*' has a
+        prefix: it matches exactly when a word of the text starts with it.
+        A term with no '*' that starts and ends with a word character and is
+        ascii in between has a literal and is found with str.find() and a check of
+        the characters either side instead of its regexes.  Its exact match
+        fallback can never add anything.
+    """
+    __slots__ = ('string', 'prefix', 'literal', 'raw_regex', 'regex', 'uni_regex', '__weakref__')
 
     def __init__(self, string):
-        self.word = string
-        if string.startswith('"'):
-            string = tagstr(string[1:-1], lineno=string.lineno, char=string.char+1)
         self.string = string
-        self.raw_regex = make_regex(string)
+        self.prefix = self.literal = None
+        if string.endswith('*'):
+            literal = string.rstrip('*')
+            m = _word_re.match(literal)
+            if m and m.end() == len(literal):
+                self.prefix = literal.lower() # ascii, so the same as re.I
+        elif _literal_re.match(string):
+            self.literal = str(string.lower())
+
+    def __getattr__(self, name):
+        # only called for attributes that aren't set yet
+        if name not in ('raw_regex', 'regex', 'uni_regex'):
+            raise AttributeError(name)
+        self.raw_regex = make_regex(self.string)
         self.regex = re.compile(self.raw_regex, re.I)
-        self.uni_regex = re.compile(re.escape(string))
+        self.uni_regex = re.compile(re.escape(self.string))
+        return getattr(self, name)
 
-    def matches(self, text):
+    @property
+    def compiled(self):
+        try:
+            object.__getattribute__(self, 'regex') # without compiling it
+        except AttributeError:
+            return False
+        return True
+
+    def matches(self, text, budget=None, fold=None):
+        """ does the term match text.  fold is the text's _Fold, for when
+            other terms are matched against it too
+        """
+        if self.literal is not None:
+            # texts are often lowercase already, and then there is no need
+            # to fold them
+            for span in self._literal_spans(text):
+                return True
+            folded = _lower(text) if fold is None else fold()
+            if folded is not None:
+                if folded != text:
+                    for span in self._literal_spans(folded):
+                        return True
+                return False
         if self.regex.search(text):
-            self.last = True
             return True
-        for m in self.uni_regex.finditer(text):
-            beg, end = m.start(), m.end()
+        for span in self._exact_spans(text, budget=budget):
+            return True
+        return False
+
+    def _spans(self, text, pos=0, fold=None):
+        """ the places the term matches from pos on, not in order """
+        if self.literal is not None:
+            folded = _lower(text) if fold is None else fold()
+            if folded is not None:
+                return self._literal_spans(folded, pos)
+        return it.chain((m.span() for m in self.regex.finditer(text, pos)), self._exact_spans(text, pos))
+
+    def _literal_spans(self, folded, pos=0):
+        # the same spans, and the same non-overlapping ones, as regex.finditer.
+        # Given a text that isn't folded only those in the same case are found
+        literal = self.literal
+        n, size = len(literal), len(folded)
+        misses = 0
+        i = folded.find(literal, pos)
+        while i >= 0:
+            end = i + n
+            if (i == 0 or folded[i-1] not in _word_chars) and \
+               (end == size or folded[end] not in _word_chars):
+                yield i, end
+                i = folded.find(literal, end)
+            else:
+                misses += 1
+                if misses > LITERAL_MISSES:
+                    # mostly inside other words, the regex skips those faster
+                    for m in self.regex.finditer(folded, i):
+                        yield m.span()
+                    return
+                i = folded.find(literal, i + 1)
+
+    def _exact_spans(self, text, pos=0, budget=None):
+        """ the case sensitive matches that are delimited by whitespace """
+        examined = 0
+        for m in self.uni_regex.finditer(text, pos):
+            if budget is not None:
+                examined += 1
+                budget.candidate(self, examined)
+            beg, end = m.span()
             if (beg == 0 or text[beg-1].isspace()) and \
                (end == len(text) or text[end].isspace() or text[end] in ',.\t '):
-                self.last = True
-                return True
-        self.last = False
+                yield beg, end
+
+    def spans(self, text, fold=None):
+        """ the sorted (start, end) of every place the term matches in text """
+        return sorted(set(self._spans(text, 0, fold)))
+
+    def match_at(self, text, pos):
+        """ does the term match text starting exactly at pos """
+        if self.literal is not None:
+            literal = self.literal
+            end = pos + len(literal)
+            word = text[pos:end]
+            if word == literal or _lower(word) == literal:
+                return (pos == 0 or text[pos-1] not in _word_chars) and \
+                       (end == len(text) or text[end] not in _word_chars)
+            return False
+        if self.regex.match(text, pos):
+            return True
+        end = pos + len(self.string)
+        if text.startswith(self.string, pos):
+            return (pos == 0 or text[pos-1].isspace()) and \
+                   (end == len(text) or text[end].isspace() or text[end] in ',.\t ')
         return False
 
+    def __repr__(self):
+        return '<Term %r>' % self.string
+
+    def __reduce__(self):
+        return intern_term, (self.string,)
+
+_terms = weakref.WeakValueDictionary()
+
+def intern_term(string):
+    """ return the shared Term for string, compiling it on first use """
+    string = unicode(string)
+    term = _terms.get(string)
+    if term is None:
+        term = _terms.setdefault(string, Term(string))
+    return term
+
+def term_paths():
+    """ how many of the terms in use take each way of matching: 'literal'
+        ones are found with str.find(), 'regex' ones with their regexes
+    """
+    terms = _terms.values()
+    literal = sum(term.literal is not None for term in terms)
+    return {'literal': literal, 'regex': len(terms) - literal}
+
+class Token(object):
+    __slots__ = ('word', 'string', 'term')
+    last = '?'
+
+    def __init__(self, string):
+        self.word = string
+        if string.startswith('"'):
+            string = tagstr(string[1:-1], lineno=string.lineno, char=string.char+1)
+        self.string = string
+        self.term = intern_term(string)
+
+    def __reduce__(self):
+        return Token, (self.word,)
+
+    prefix = property(lambda self: self.term.prefix)
+    raw_regex = property(lambda self: self.term.raw_regex)
+    regex = property(lambda self: self.term.regex)
+    uni_regex = property(lambda self: self.term.uni_regex)
+
+    def matches(self, text, budget=None, fold=None):
+        return self.term.matches(text, budget, fold)
+
+    def match_at(self, text, pos):
+        return self.term.match_at(text, pos)
+
     def __repr__(self):
         return '<Token %r (%d, %d)>' % (self.string, self.string.lineno, self.string.char)
 
@@ -258,52 +991,1719 @@ class Token(object):
             return repr(self.string)
         return self.string
 
+def _nest(lexemes):
+    """ turn the lexemes into nested lists, one list per parenthesized group """
+    root = []
+    stack = [root]
+    for lexeme in lexemes:
+        if lexeme.kind == OPEN:
+            group = []
+            stack[-1].append(group)
+            stack.append(group)
+        elif lexeme.kind == CLOSE:
+            stack.pop()
+        else:
+            stack[-1].append(lexeme)
+    return root
+
+def _is_word(item, word):
+    return not isinstance(item, list) and item.text.upper() == word
+
+def _unstar(word, grouped):
+    # backwards compatible bugs: a bare '*' is dropped, '*'s that are not at
+    # the end of a word are dropped, and all '*'s inside groups are dropped
+    text = word.text
+    if '*' in text and (grouped or text == '*' or not text.endswith('*')):
+        return Lexeme(WORD, text.replace('*', ''), word.lineno, word.char)
+    return word
+
+def _is_operand(item, side):
+    return isinstance(item, list) or (item.text and (side is not None or not _is_word(item, 'AND')))
+
+def _plan(items, grouped, levels):
+    """ check one level of the pattern and work out its ANDs and ORs.
+        Returns the OR'd groups of AND'd operands.  An operand is a Token
+        or (level, negated) for a sub-level that is appended to levels.
+    """
+    if grouped:
+        # every '*' in a group goes before the group is parsed, and with it
+        # any word that was only '*'s
+        items = [item if isinstance(item, list) else _unstar(item, True) for item in items]
+        items = [item for item in items if isinstance(item, list) or item.text]
+    units = []
+    i = 0
+    while i < len(items):
+        item = items[i]
+        if _is_word(item, 'NOT'):
+            if i + 1 == len(items):
+                raise ParseException("trailing NOT on line %d" % item.lineno)
+            operand = items[i+1]
+            if not isinstance(operand, list) and _is_word(_unstar(operand, grouped), 'NOT'):
+                # a NOT of a NOT is a trailing NOT on the first one's line
+                operand = Lexeme(WORD, operand.text, item.lineno, operand.char)
+            units.append((operand, True))
+            i += 2
+        else:
+            if not isinstance(item, list):
+                item = _unstar(item, grouped)
+            units.append((item, False))
+            i += 1
+
+    ors = [[]]
+    i = 0
+    while i < len(units):
+        item, negated = units[i]
+        if not negated and _is_word(item, 'OR'):
+            if i + 1 == len(units):
+                raise ParseException("bare OR at beginning of terms")
+            if i == 0:
+                raise ParseException("bare OR at end of terms line %d" % item.lineno)
+            # the units either side of an OR are its operands, even keywords
+            ors[-1][-1] = ors[-1][-1][:2] + ('left',)
+            ors.append([units[i+1] + ('right',)])
+            i += 2
+        else:
+            ors[-1].append((item, negated, None))
+            i += 1
+    # words that were only '*'s are gone, and so are any ORs they leave
+    # dangling, and ANDs that aren't an OR's operand just separate words
+    ors = [ands for ands in ([unit for unit in ands if unit[1] or _is_operand(unit[0], unit[2])]
+                             for ands in ors) if ands] or [[]]
+
+    plan = []
+    for ands in ors:
+        operands = []
+        for item, negated, side in ands:
+            if isinstance(item, list):
+                operands.append((len(levels), negated))
+                levels.append((item, True))
+            elif negated:
+                operands.append((len(levels), negated))
+                levels.append(([item], grouped))
+            elif _is_word(item, 'NOT'): # a word that was NOT and '*'s
+                if side != 'left':
+                    raise ParseException("trailing NOT on line %d" % item.lineno)
+                # which always took the OR after it as its operand
+                operands.append((len(levels), True))
+                levels.append(([Lexeme(WORD, 'OR', item.lineno, item.char)], grouped))
+            else:
+                operands.append(Token(tagstr(item.text, lineno=item.lineno, char=item.char)))
+        plan.append(operands)
+    return plan
+
 def make_parse_tree(pattern):
+    """ parse pattern into a tree of AND/OR/NOT nodes with Token leaves.
+        ANDs bind tighter than ORs, a NOT applies to the next word or group.
+        Groups are handled with explicit stacks so there is no limit on how
+        long or deeply nested a pattern can be.
+    """
     pattern = tagstr(pattern.strip(), lineno=getattr(pattern, 'lineno', 0), char=getattr(pattern, 'char', 0))
+    tree = _build(_nest(_lex(pattern)), False)
+    tree.flatten()
+    return tree
+
+def _build(items, grouped):
+    """ the unflattened tree for one level of nested lexemes and everything in it """
+    levels = [(items, grouped)] # (items, inside parens)
+    plans = {}
+    # check the levels outside-in and left to right, the order the errors were always raised in
+    stack = [0]
+    while stack:
+        index = stack.pop()
+        first_child = len(levels)
+        plans[index] = _plan(levels[index][0], levels[index][1], levels)
+        stack.extend(reversed(range(first_child, len(levels))))
+    # build them inside-out
+    built = {}
+    for index in reversed(range(len(levels))):
+        groups = []
+        for operands in plans.pop(index):
+            parts = []
+            for operand in operands:
+                if isinstance(operand, tuple):
+                    level, negated = operand
+                    operand = built.pop(level)
+                    if negated:
+                        operand = NOT(operand)
+                parts.append(operand)
+            groups.append(parts[0] if len(parts) == 1 else AND(parts))
+        built[index] = AND([groups[0] if len(groups) == 1 else OR(groups)])
+    return built[0]
+
+def _common_prefix(a, b):
+    """ how many characters a and b start with in common """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi: # a binary search, so the comparing is done on slices in C
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
 
-    parts = tokenize(pattern)
-    # stage 1, text and NOTs
-    for i, part in enumerate(parts):
-        if part.startswith('('):
-            parts[i] = make_parse_tree(tagstr(part[1:-1], lineno=part.lineno, char=part.char+1))
-        elif part in {'AND', 'OR'}:
-            pass
+def _common_suffix(a, b, limit):
+    """ how many characters, up to limit, a and b end with in common """
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a)-mid:len(a)-lo] == b[len(b)-mid:len(b)-lo]:
+            lo = mid
         else:
-            if part.startswith('NOT '):
-                part = tagstr(part[len('NOT '):], lineno=part.lineno, char=part.char)
-                part = NOT(make_parse_tree(part))
+            hi = mid - 1
+    return lo
+
+def _moved_token(token, chars, lines):
+    # the same term, so no need to go through Token() again
+    moved = Token.__new__(Token)
+    word, string = token.word, token.string
+    moved.word = tagstr(word, lineno=word.lineno + lines, char=word.char + chars)
+    if string is word:
+        moved.string = moved.word
+    else:
+        moved.string = tagstr(string, lineno=string.lineno + lines, char=string.char + chars)
+    moved.term = token.term
+    return moved
+
+def _moved(tree, chars, lines):
+    """ a copy of a parsed tree with every position moved along """
+    if isinstance(tree, Token):
+        return _moved_token(tree, chars, lines)
+    built = []
+    for node in postorder(tree):
+        if isinstance(node, AND):
+            n = len(node.parts)
+            parts = built[len(built)-n:]
+            del built[len(built)-n:]
+            built.append(node.__class__(parts))
+        elif isinstance(node, NOT):
+            built.append(NOT(built.pop()))
+        else:
+            built.append(_moved_token(node, chars, lines))
+    return built[0]
+
+def _bisect_units(units, pos, lo, key):
+    """ the first of units from lo on whose start or end, as key says, is at least pos """
+    hi = len(units)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if getattr(units[mid], key) < pos:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class _Unit(object):
+    """ a word, group or NOT and its operand on one level of a pattern, see IncrementalParser """
+    __slots__ = ('start', 'end', 'word', 'negated', 'node', 'group')
+
+    def __init__(self, start, end, word, negated, node, group=None):
+        self.start = start # from where its level starts
+        self.end = end
+        self.word = word # the upper cased text _plan() checks for keywords, None for groups
+        self.negated = negated
+        self.node = node # the flattened subtree, None for keywords and '*'s
+        # for a group: where its level starts and its ')' is, the level's
+        # units, and the characters and lines their subtrees are behind by
+        self.group = group
+
+    def moved(self, delta, chars, lines):
+        """ the unit delta characters further along its level, with the
+            positions in its subtree chars characters and lines lines on
+        """
+        node, group = self.node, self.group
+        if node is not None and (chars or lines):
+            node = _moved(node, chars, lines)
+        if group is not None:
+            begin, close, units, behind, lines_behind = group
+            # the group's own units are only moved if an edit goes inside it
+            group = (begin + delta, close + delta, units, behind + chars, lines_behind + lines)
+        return _Unit(self.start + delta, self.end + delta, self.word, self.negated, node, group)
+
+class IncrementalParser(object):
+    """ parses a pattern as it is edited, reusing what didn't change.
+        parse(pattern) returns the same tree as make_parse_tree(pattern).
+        Each level of the pattern is kept as its words, groups and NOTs.
+        An edit inside a group only lexes that group's level again, from
+        the word or group before the change to the first one after it that
+        starts where it did.  The subtrees before the change are reused as
+        they are, and new tokens get the interned, already compiled, terms.
+        The ones after it are copied with their positions moved, unless
+        the edit kept the length and lines the same, and the levels around
+        the change are put back together.  So an edit costs a pass over
+        the levels it is inside and a copy of the tokens after it: a few
+        percent of a full parse inside one group of a long pattern, but
+        about half of one near the front of a long flat pattern.
+        Consecutive trees share the subtrees that didn't change.
+    """
+    def __init__(self):
+        self.text = u''
+        self.base = None # (lineno, char) the pattern starts at
+        self.units = []
+        self.edit = None # (first changed, end of the change before it, chars added, lines added)
+
+    def parse(self, pattern):
+        base = (getattr(pattern, 'lineno', 0), getattr(pattern, 'char', 0))
+        text = tagstr(pattern.strip(), lineno=base[0], char=base[1])
+        if base != self.base:
+            self.text, self.units = u'', []
+        old = self.text
+        prefix = _common_prefix(old, text)
+        suffix = _common_suffix(old, text, min(len(old), len(text)) - prefix)
+        self.edit = (prefix, len(old) - suffix, len(text) - len(old),
+                     text.count('\n', prefix, len(text) - suffix) - old.count('\n', prefix, len(old) - suffix))
+        try:
+            units = self._levels(text)
+            tree = self._assemble(units)
+        except ParseException:
+            # let a full parse raise whichever error it finds first
+            self.text, self.base, self.units = u'', None, []
+            return make_parse_tree(pattern)
+        self.text, self.base, self.units = text, base, units
+        return tree
+
+    def _levels(self, text):
+        # find the innermost group the change is inside
+        prefix, changed, delta, lines = self.edit
+        outer = [] # (units, index, base, grouped, end) for each level around it
+        units, base, grouped, end = self.units, 0, False, len(text)
+        while True:
+            reuse = _bisect_units(units, prefix - base, 0, 'end')
+            if reuse < len(units) and units[reuse].group is not None and units[reuse].end == prefix - base:
+                reuse += 1 # nothing after a ')' can change the group
+            if reuse == len(units) or units[reuse].group is None:
+                break
+            begin, close, inner, behind, lines_behind = units[reuse].group
+            if base + begin > prefix or base + close < changed:
+                break
+            outer.append((units, reuse, base, grouped, end))
+            if behind or lines_behind:
+                inner = [unit.moved(0, behind, lines_behind) for unit in inner]
+            units, base, grouped, end = inner, base + begin, True, base + close + delta
+        while True:
+            try:
+                new = self._relex(text, units, reuse, base, grouped, end)
+                break
+            except ParseException:
+                if not outer:
+                    raise
+                # the parens don't pair up as they did, or something in the
+                # group is wrong, so try again on the level around it
+                units, reuse, base, grouped, end = outer.pop()
+        # and put the groups around it back together
+        while outer:
+            units, reuse, base, grouped, end = outer.pop()
+            unit = units[reuse]
+            begin, close = unit.group[:2]
+            node = self._assemble(new)
+            if unit.negated:
+                node = NOT(node)
+                node._flatten()
+            unit = _Unit(unit.start, unit.end + delta, None, unit.negated, node, (begin, close + delta, new, 0, 0))
+            new = units[:reuse] + [unit] + [each.moved(delta, delta, lines) for each in units[reuse+1:]]
+        return new
+
+    def _relex(self, text, units, reuse, base, grouped, end):
+        # lex the level from where its first unit that might have changed
+        # starts, until a unit starts where one did before the change
+        prefix, changed, delta, lines = self.edit
+        new = level = units[:reuse]
+        outer = [] # (level, negate, where the '(' is, base, grouped) for the groups being lexed
+        negate = None # a NOT waiting for its operand, and where it was
+        for lexeme in _lex(text, base + units[reuse-1].end if reuse else base, end):
+            pos = lexeme.char - text.char
+            if not outer and negate is None and pos >= changed + delta:
+                # the rest of the level, and so its lexing, is the same as
+                # last time if a unit started here then too
+                j = _bisect_units(units, pos - delta - base, reuse, 'start')
+                if j < len(units) and units[j].start == pos - delta - base:
+                    new.extend(unit.moved(delta, delta, lines) for unit in units[j:])
+                    return new
+            if lexeme.kind == OPEN:
+                outer.append((level, negate, pos, base, grouped))
+                level, negate, base, grouped = [], None, pos + 1, True
+            elif lexeme.kind == CLOSE:
+                if negate is not None:
+                    raise ParseException("trailing NOT on line %d" % negate[0].lineno)
+                inner, node = level, self._assemble(level)
+                level, negate, paren, base, grouped = outer.pop()
+                begin = paren
+                if negate is not None:
+                    node = NOT(node)
+                    node._flatten()
+                    begin = negate[1]
+                level.append(_Unit(begin - base, pos + 1 - base, None, negate is not None, node,
+                                   (paren + 1 - base, pos - base, inner, 0, 0)))
+                negate = None
+            else:
+                stop = pos + len(lexeme.text)
+                if grouped:
+                    # every '*' in a group goes first, see _plan()
+                    lexeme = _unstar(lexeme, True)
+                    if not lexeme.text:
+                        continue
+                if negate is not None:
+                    level.append(self._negated(negate, lexeme, stop, base, grouped))
+                    negate = None
+                elif _is_word(lexeme, 'NOT'):
+                    negate = (lexeme, pos)
+                else:
+                    level.append(self._plain(lexeme, pos, stop, base, grouped))
+        if negate is not None:
+            raise ParseException("trailing NOT on line %d" % negate[0].lineno)
+        return new
+
+    def _negated(self, negate, item, end, base, grouped):
+        # the same subtree _plan() and _build() make for a NOT and a word
+        node = NOT(_build([item], grouped))
+        node.flatten()
+        return _Unit(negate[1] - base, end - base, item.text.upper(), True, node)
+
+    def _plain(self, item, begin, end, base, grouped):
+        item = _unstar(item, grouped)
+        if _is_word(item, 'NOT'):
+            raise ParseException("trailing NOT on line %d" % item.lineno)
+        node = None
+        if item.text: # keywords too, for when they are an OR's operand
+            node = Token(tagstr(item.text, lineno=item.lineno, char=item.char))
+        return _Unit(begin - base, end - base, item.text.upper(), False, node)
+
+    def _assemble(self, units):
+        # the rest of _plan() and _build() for a level
+        ors = [[]]
+        operands = set() # the units next to an OR
+        i = 0
+        while i < len(units):
+            unit = units[i]
+            if not unit.negated and unit.word == 'OR':
+                if i + 1 == len(units):
+                    raise ParseException("bare OR at beginning of terms")
+                if i == 0:
+                    raise ParseException("bare OR at end of terms")
+                operands.update((i - 1, i + 1))
+                ors.append([i + 1])
+                i += 2
+            else:
+                ors[-1].append(i)
+                i += 1
+        ors = [ands for ands in ([units[i] for i in ands if units[i].node is not None and
+                                  (units[i].negated or units[i].word != 'AND' or i in operands)]
+                                 for ands in ors) if ands] or [[]]
+        groups = []
+        for ands in ors:
+            if len(ands) == 1:
+                groups.append(ands[0].node)
+            else:
+                group = AND([unit.node for unit in ands])
+                group._flatten()
+                groups.append(group)
+        if len(groups) == 1:
+            tree = AND([groups[0]])
+        else:
+            top = OR(groups)
+            top._flatten()
+            tree = AND([top])
+        tree._flatten()
+        return tree
+
+class TermStats(object):
+    """ how likely each term is to match, used by optimize() to order the
+        children of ANDs and ORs.  Seed it with a table of frequencies
+        (term string -> fraction of documents) and/or let it learn from
+        documents as they go by.
+    """
+    def __init__(self, frequencies=None):
+        self.frequencies = dict(frequencies or {})
+        self.seen = {}
+        self.hits = {}
+
+    def observe(self, string, hit):
+        self.seen[string] = self.seen.get(string, 0) + 1
+        if hit:
+            self.hits[string] = self.hits.get(string, 0) + 1
+
+    def learn(self, tree, text):
+        """ record whether each term in tree matches text """
+        fold = _Fold(text)
+        for tok in tree_tokens(tree):
+            self.observe(tok.term.string, tok.term.matches(text, None, fold))
+
+    def probability(self, string):
+        seen = self.seen.get(string)
+        if seen:
+            return (self.hits.get(string, 0) + 1.0) / (seen + 2.0)
+        if string in self.frequencies:
+            return self.frequencies[string]
+        # longer terms and phrases are rarer, wildcards are more common
+        guess = 0.5 / (1 + len(string.split()))
+        if string.endswith('*'):
+            guess *= 2
+        return guess
+
+def tree_tokens(tree):
+    """ every Token in tree, left to right """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, NOT):
+            stack.append(node.tree)
+        elif isinstance(node, AND):
+            stack.extend(reversed(node.parts))
+        else:
+            yield node
+
+def _estimate(node, stats, estimates):
+    """ (cost, probability of matching) for an already optimized node """
+    if isinstance(node, Token):
+        string = node.term.string
+        cost = 1.0 + 0.1 * len(string.split()) + (0.5 if string.endswith('*') else 0)
+        return cost, min(max(stats.probability(string), 0.0), 1.0)
+    return estimates.get(id(node), (1.0, 0.5))
+
+def _order(parts, stats, estimates, is_or):
+    """ order children so the ones most likely to decide the node cheaply go first,
+        return the ordered children and the estimate for the node
+    """
+    estimates = [_estimate(part, stats, estimates) for part in parts]
+    def rank(i):
+        cost, p = estimates[i]
+        decides = p if is_or else 1.0 - p
+        return cost / decides if decides else float('inf')
+    order = sorted(range(len(parts)), key=rank)
+    cost, reach = 0.0, 1.0 # reach is the chance evaluation gets to the next child
+    for i in order:
+        c, p = estimates[i]
+        cost += reach * c
+        reach *= p if not is_or else 1.0 - p
+    p = 1.0 - reach if is_or else reach
+    return [parts[i] for i in order], (cost, p)
+
+def optimize(tree, stats=None):
+    """ return an equivalent tree that is cheaper to evaluate.
+        Nested ANDs and ORs are merged, double NOTs removed, repeated terms
+        dropped, and empty groups (which are always true) folded away.
+        AND children are ordered most-likely-to-fail first and OR children
+        most-likely-to-match first using the probabilities in stats.
+    """
+    if stats is None:
+        stats = TermStats()
+    TRUE, FALSE = AND(), OR()
+    estimates = {}
+    stack = [(tree, False)]
+    done = []
+    while stack:
+        node, visited = stack.pop()
+        if isinstance(node, NOT):
+            if not visited:
+                stack.append((node, True))
+                stack.append((node.tree, False))
+                continue
+            child = done.pop()
+            if child is TRUE:
+                done.append(FALSE)
+            elif child is FALSE:
+                done.append(TRUE)
+            elif isinstance(child, NOT):
+                done.append(child.tree)
             else:
-                part = Token(part)
-            parts[i] = part
-    # stage 2, ANDs & ORs
-    count = 0
-    parts = parts[::-1]
-    for op, opclass in [('AND', AND), ('OR', OR)]:
-        result = []
-        while parts:
+                new = NOT(child)
+                cost, p = _estimate(child, stats, estimates)
+                estimates[id(new)] = cost, 1.0 - p
+                done.append(new)
+        elif isinstance(node, AND):
+            if not visited:
+                stack.append((node, True))
+                stack.extend((part, False) for part in reversed(node.parts))
+                continue
+            is_or = isinstance(node, OR)
+            identity, absorbing = (FALSE, TRUE) if is_or else (TRUE, FALSE)
+            n = len(node.parts)
+            children = done[len(done)-n:]
+            del done[len(done)-n:]
+            parts, terms = [], set()
+            for child in children:
+                if child.__class__ is node.__class__ and child is not identity:
+                    grandchildren = child.parts
+                else:
+                    grandchildren = [child]
+                for part in grandchildren:
+                    if isinstance(part, Token):
+                        if part.term in terms:
+                            continue
+                        terms.add(part.term)
+                    if part is identity:
+                        continue
+                    parts.append(part)
+            if any(part is absorbing for part in parts):
+                done.append(absorbing)
+            elif not parts:
+                done.append(identity)
+            elif len(parts) == 1:
+                done.append(parts[0])
+            else:
+                parts, estimate = _order(parts, stats, estimates, is_or)
+                new = node.__class__(parts)
+                estimates[id(new)] = estimate
+                done.append(new)
+        else:
+            done.append(node)
+    root = done[0]
+    if root is FALSE:
+        return AND([OR()])
+    if root.__class__ is not AND:
+        return AND([root])
+    return root
+
+class DocumentIndex(object):
+    """ the words of one text and where they are, so terms are decided by
+        lookups instead of regex scans of the whole text.
+        DocumentIndex(text).matches(tree) == tree.matches(text)
+    """
+    def __init__(self, text):
+        self.text = text
+        self.words = {} # lowercased word -> start offsets
+        for m in _word_re.finditer(text):
+            self.words.setdefault(m.group().lower(), []).append(m.start())
+        self.vocab = None # sorted words, built for the first wildcard
+        self.results = {} # Term -> bool
+        self.fold = _Fold(text)
+
+    def matches(self, tree):
+        return _evaluate(tree, self.token_matches)
+
+    def token_matches(self, tok):
+        return self.contains(tok.term)
+
+    def contains(self, term):
+        found = self.results.get(term)
+        if found is None:
+            text = self.text
+            offsets = self.candidates(term)
+            if offsets is None:
+                found = term.matches(text, None, self.fold)
+            else:
+                found = any(term.match_at(text, pos) for pos in offsets)
+            self.results[term] = found
+        return found
+
+    def candidates(self, term):
+        """ offsets where term might start.  Every word of the term has to be
+            a whole word of the text, except a trailing wildcard word which
+            only has to start one.  Use whichever word of the term is rarest.
+            None means the term has to be found by scanning.
+        """
+        string = term.string
+        literal = string.rstrip('*') if string.endswith('*') else string
+        best = None
+        for m in _word_re.finditer(literal):
+            word = m.group().lower()
+            if m.end() == len(literal) and literal != string:
+                offsets = self.prefixed(word)
+            else:
+                offsets = self.words.get(word, ())
+            if best is None or len(offsets) < len(best[1]):
+                best = m.start(), offsets
+        if best is None: # no words in the term, find it the slow way
+            text, c = self.text, literal[:1]
+            if not c or c.isspace():
+                return None
+            pos = text.find(c)
+            offsets = []
+            while pos >= 0:
+                offsets.append(pos)
+                pos = text.find(c, pos + 1)
+            return offsets
+        k, offsets = best
+        return [pos - k for pos in offsets if pos >= k]
+
+    def prefixed(self, prefix):
+        if self.vocab is None:
+            self.vocab = sorted(self.words)
+        vocab = self.vocab
+        offsets = []
+        for i in xrange(bisect_left(vocab, prefix), len(vocab)):
+            if not vocab[i].startswith(prefix):
+                break
+            offsets.extend(self.words[vocab[i]])
+        return offsets
+
+class Automaton(object):
+    """ Aho-Corasick automaton, finds every occurrence of every key in one pass """
+    def __init__(self, keys):
+        goto, fail, out = [{}], [0], [[]]
+        for key in keys:
+            state = 0
+            for c in key:
+                nxt = goto[state].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto.append({})
+                    fail.append(0)
+                    out.append([])
+                    goto[state][c] = nxt
+                state = nxt
+            out[state].append(key)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in goto[state].iteritems():
+                queue.append(nxt)
+                f = fail[state]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(c, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+        self.goto, self.fail, self.out = goto, fail, out
+
+    def scan(self, text):
+        """ yield (start, key) for every occurrence of a key in text """
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for key in out[state]:
+                yield i + 1 - len(key), key
+
+TERM, ALL, ANY, NEG = range(4)
+
+class PatternSet(object):
+    """ match one text against many patterns in a single pass.
+        Every distinct term is found with one shared automaton scan, then
+        the AND/OR/NOT structure of each pattern is evaluated against the
+        set of terms that were found.  Identical subexpressions, in one
+        pattern or across patterns, are stored and evaluated only once.
+    """
+    def __init__(self, patterns=()):
+        self.ids = []
+        self.roots = []
+        self.nodes = [] # (op, arg) in dependency order, children before parents
+        self.index = {} # (op, arg) -> slot in nodes
+        self.terms = set()
+        self.scan_terms = set() # terms with nothing to put in the automaton
+        self.keys = {} # automaton key -> terms that need checking there
+        self.automaton = None
+        for query_id, pattern in patterns:
+            self.add(query_id, pattern)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['automaton'] = None # cheaper to rebuild than to pickle
+        return state
+
+    def add(self, query_id, pattern):
+        """ add a pattern string or a parsed tree.  match() lowercases the
+            text like matches() does, so a tree's terms are lowercased too
+            and it matches like its pattern would.
+        """
+        if isinstance(pattern, basestring):
+            pattern = make_parse_tree(pattern.lower())
+        self.ids.append(query_id)
+        self.roots.append(self._add_tree(pattern))
+        self.automaton = None
+
+    def _add_term(self, term):
+        if term not in self.terms:
+            self.terms.add(term)
+            string = term.string
+            literal = string.rstrip('*') if string.endswith('*') else string
+            if not literal:
+                self.scan_terms.add(term)
+            for key in set([literal, string]) - set(['']):
+                self.keys.setdefault(key, []).append(term)
+        return self._node(TERM, term)
+
+    def _add_tree(self, tree):
+        # iterative post-order walk, child slots are collected on the stack
+        stack = [(tree, False)]
+        slots = []
+        while stack:
+            node, done = stack.pop()
+            if isinstance(node, NOT):
+                if done:
+                    slots.append(self._node(NEG, slots.pop()))
+                else:
+                    stack.append((node, True))
+                    stack.append((node.tree, False))
+            elif isinstance(node, AND):
+                if done:
+                    n = len(node.parts)
+                    children = slots[len(slots)-n:]
+                    del slots[len(slots)-n:]
+                    slots.append(self._node(ANY if isinstance(node, OR) else ALL, children))
+                else:
+                    stack.append((node, True))
+                    stack.extend((part, False) for part in reversed(node.parts))
+            else:
+                term = node.term
+                if term.string != term.string.lower():
+                    term = intern_term(term.string.lower())
+                slots.append(self._add_term(term))
+        return slots[0]
+
+    def _node(self, op, arg):
+        if op in (ALL, ANY):
+            arg = tuple(sorted(set(arg))) # AND and OR ignore order and repeats
+            if len(arg) == 1:
+                return arg[0]
+        elif op == NEG and self.nodes[arg][0] == NEG:
+            return self.nodes[arg][1]
+        key = (op, arg)
+        slot = self.index.get(key)
+        if slot is None:
+            slot = self.index[key] = len(self.nodes)
+            self.nodes.append(key)
+        return slot
+
+    def found_terms(self, text, budget=None):
+        """ the set of Terms that match the (lowercased) text.  With a
+            budget each place a term might start is a step.
+        """
+        if self.automaton is None:
+            self.automaton = Automaton(self.keys)
+        found = set()
+        keys = self.keys
+        for pos, key in self.automaton.scan(text):
+            if budget is not None:
+                budget.step()
+            for term in keys[key]:
+                if term not in found and term.match_at(text, pos):
+                    found.add(term)
+        fold = _Fold(text)
+        for term in self.scan_terms:
+            if term.matches(text, budget, fold):
+                found.add(term)
+        return found
+
+    def match(self, text, budget=None):
+        """ return the ids of every pattern that matches text """
+        found = self.found_terms(text.lower(), budget)
+        values = []
+        for op, arg in self.nodes:
+            if op == TERM:
+                values.append(arg in found)
+            elif op == ALL:
+                values.append(all(values[slot] for slot in arg))
+            elif op == ANY:
+                values.append(any(values[slot] for slot in arg))
+            else:
+                values.append(not values[arg])
+        return [query_id for query_id, root in it.izip(self.ids, self.roots) if values[root]]
+
+    def match_bits(self, texts):
+        """ match a batch of texts and return a bitset per pattern, in the
+            order of self.ids: an int with bit i set if texts[i] matches.
+            Each term's scan results are gathered into one bitset over the
+            batch, then every node is evaluated once for the whole batch
+            with bitwise ops instead of once per text.
+        """
+        bits = {} # term -> the texts it was found in
+        count = 0
+        for text in texts:
+            bit = 1 << count
+            for term in self.found_terms(text.lower()):
+                bits[term] = bits.get(term, 0) | bit
             count += 1
-            part = parts.pop()
-            if part == op:
-                result.append(opclass([result.pop(), parts.pop()]))
-                if not count % 200: # copy overhead versus stack blowing
-                    result[-1].flatten()
+        everything = (1 << count) - 1
+        values = []
+        for op, arg in self.nodes:
+            if op == TERM:
+                value = bits.get(arg, 0)
+            elif op == ALL:
+                value = everything
+                for slot in arg:
+                    value &= values[slot]
+            elif op == ANY:
+                value = 0
+                for slot in arg:
+                    value |= values[slot]
             else:
-                result.append(part)
-        parts = result
-    tree = AND(parts)
-    tree.flatten()
-    return tree
+                value = everything ^ values[arg]
+            values.append(value)
+        return [values[root] for root in self.roots]
+
+    def match_matrix(self, texts):
+        """ the texts x patterns match matrix of a batch: a list of booleans
+            for each text, one per pattern in the order of self.ids.
+            See match_bits().
+        """
+        texts = list(texts)
+        if not texts or not self.ids:
+            return [[] for text in texts]
+        width = '0%db' % len(texts)
+        columns = [format(bits, width)[::-1] for bits in self.match_bits(texts)]
+        return [map('1'.__eq__, row) for row in it.izip(*columns)]
+
+_worker_patterns = None
+
+def _init_worker(patterns):
+    global _worker_patterns
+    _worker_patterns = patterns
+
+def _match_document(text):
+    return _worker_patterns.match(text)
 
-def matches(pattern, text):
-    return make_parse_tree(pattern.lower()).matches(text.lower())
+def _match_numbered(item):
+    i, text = item
+    return i, _worker_patterns.match(text)
 
-def pprint_tree(node, indent=0):
-    if False and node.last == '?':
+def _match_batch(batch):
+    ids = _worker_patterns.ids
+    rows = _worker_patterns.match_matrix(text for i, text in batch)
+    return [(i, [query_id for query_id, hit in it.izip(ids, row) if hit]) for (i, text), row in it.izip(batch, rows)]
+
+def _match_batch_caught(batch):
+    # a pool only calls back for results, so errors are sent back as results too
+    try:
+        return True, _match_batch(batch)
+    except Exception as e:
+        return False, e
+
+def _pattern_set(patterns):
+    if isinstance(patterns, PatternSet):
+        return patterns
+    if hasattr(patterns, 'items'):
+        return PatternSet(patterns.items())
+    return PatternSet(enumerate(patterns))
+
+def match_many(patterns, documents, processes=0, chunksize=64, ordered=True):
+    """ match every document against every pattern.
+        patterns is a PatternSet, a dict of id -> pattern, or a sequence of
+        patterns whose ids are their positions.  Yields the list of matching
+        ids for each document in order, or (document index, ids) pairs as
+        they finish if ordered is False.
+        With processes the documents are spread over a multiprocessing pool
+        in chunks of chunksize.  The patterns are compiled once, here, and
+        each worker gets them once when it starts.
+    """
+    patterns = _pattern_set(patterns)
+    if not processes:
+        for i, text in enumerate(documents):
+            ids = patterns.match(text)
+            yield ids if ordered else (i, ids)
         return
-    print ' ' * indent * 2, str(node.last)[0], node.word
-    if getattr(node, 'parts', []):
-        for part in node.parts:
-            pprint_tree(part, indent+1)
+    pool = multiprocessing.Pool(processes, _init_worker, (patterns,))
+    try:
+        if ordered:
+            results = pool.imap(_match_document, documents, chunksize)
+        else:
+            results = pool.imap_unordered(_match_numbered, enumerate(documents), chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class MatchService(object):
+    """ a long running pool of worker processes that match documents
+        against a fixed set of patterns, for services that feed documents
+        in as they arrive.  patterns is anything match_many() takes, trees
+        included; it is compiled once and each worker gets it when it
+        starts.
+        match() only pulls a document off its iterator when there is room:
+        at most max_pending batches are out at the workers at once.  Small
+        documents are sent in batches of up to batch_size documents or
+        batch_chars characters, so the per-batch dispatch cost is shared.
+        With processes=0 everything runs in the calling thread.
+    """
+    def __init__(self, patterns, processes=None, max_pending=None, batch_size=256, batch_chars=64 * 1024):
+        self.patterns = _pattern_set(patterns)
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.max_pending = max_pending or 2 * max(self.processes, 1)
+        self.batch_size = batch_size
+        self.batch_chars = batch_chars
+        self.pool = None
+        if self.processes:
+            self.pool = multiprocessing.Pool(self.processes, _init_worker, (self.patterns,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def batches(self, documents):
+        """ yield lists of (document index, text) """
+        batch, chars = [], 0
+        for item in enumerate(documents):
+            batch.append(item)
+            chars += len(item[1])
+            if len(batch) >= self.batch_size or chars >= self.batch_chars:
+                yield batch
+                batch, chars = [], 0
+        if batch:
+            yield batch
+
+    def match(self, documents, ordered=True):
+        """ yield the list of matching ids for each document, in order, or
+            (document index, ids) pairs as they finish if ordered is False
+        """
+        if self.pool is None:
+            for i, text in enumerate(documents):
+                ids = self.patterns.match(text)
+                yield ids if ordered else (i, ids)
+            return
+        pending = deque() # the batches out at the workers, oldest first
+        finished = Queue.Queue() # (ok, results) of each batch as it finishes, unless ordered
+        for batch in self.batches(documents):
+            if ordered:
+                pending.append(self.pool.apply_async(_match_batch, (batch,)))
+            else:
+                pending.append(self.pool.apply_async(_match_batch_caught, (batch,), callback=finished.put))
+            while len(pending) >= self.max_pending:
+                for result in self._finished(pending, finished, ordered):
+                    yield result
+        while pending:
+            for result in self._finished(pending, finished, ordered):
+                yield result
+
+    def _finished(self, pending, finished, ordered):
+        """ wait for a batch to finish, the oldest if ordered, and return its results """
+        if ordered:
+            return [ids for i, ids in pending.popleft().get()]
+        ok, results = finished.get()
+        pending.popleft() # unordered they are only counted
+        if not ok:
+            raise results
+        return results
+
+# compiled query files: a header, a table of record offsets, a table of string
+# offsets, the records, then the strings (utf-8).  All integers little endian.
+#   header  magic 'BMQF', version H, query count I, string count I
+#   record  id kind B (0 int, 1 string), id i, op count I, leaf count I,
+#           ops B * op count, args i * op count, (word, lineno, char) I * 3 * leaf count
+QUERY_MAGIC = 'BMQF'
+QUERY_VERSION = 1
+_query_header = struct.Struct('<4sHII')
+_query_record = struct.Struct('<BiII')
+
+def _pack(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+def _unpack(typecode, data, offset, count):
+    values = array(typecode)
+    values.fromstring(data[offset:offset + count * values.itemsize])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def dumps_queries(queries):
+    """ serialize (id, query) pairs to a string.  A query is a pattern, a
+        parse tree, or an untraced Program.  Ids are strings or ints that
+        fit in 32 bits.
+    """
+    strings, string_ids = [], {}
+    def string_id(s):
+        s = unicode(s)
+        if s not in string_ids:
+            string_ids[s] = len(strings)
+            strings.append(s.encode('utf-8'))
+        return string_ids[s]
+
+    records = []
+    for query_id, query in queries:
+        if isinstance(query, basestring):
+            query = make_parse_tree(query)
+        program = query if isinstance(query, Program) else query.compile()
+        if program.traced:
+            raise ValueError("traced programs can't be serialized")
+        if isinstance(query_id, (int, long)):
+            if not -2**31 <= query_id < 2**31:
+                raise ValueError('int query ids must fit in 32 bits, not %d' % query_id)
+            kind, query_id = 0, query_id
+        elif isinstance(query_id, basestring):
+            kind, query_id = 1, string_id(query_id)
+        else:
+            raise TypeError('query ids must be ints or strings, not %r' % (query_id,))
+        leaves = []
+        for leaf in program.leaves:
+            leaves.extend((string_id(leaf.word), leaf.word.lineno, leaf.word.char))
+        records.append(''.join([_query_record.pack(kind, query_id, len(program), len(program.leaves)),
+                                _pack('B', program.ops), _pack('i', program.args), _pack('I', leaves)]))
+
+    record_offsets, string_offsets = [0], [0]
+    for record in records:
+        record_offsets.append(record_offsets[-1] + len(record))
+    for s in strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+    return ''.join([_query_header.pack(QUERY_MAGIC, QUERY_VERSION, len(records), len(strings)),
+                    _pack('I', record_offsets), _pack('I', string_offsets)] + records + strings)
+
+def dump_queries(queries, fileobj):
+    """ write (id, query) pairs to an open binary file, see dumps_queries() """
+    fileobj.write(dumps_queries(queries))
+
+class QueryFile(object):
+    """ the queries in a compiled query file, read lazily from data, which
+        can be a string or an mmap.  Each query is turned back into a Program
+        the first time it is asked for, and its terms compile their regexes
+        the first time they are evaluated.  Iterating gives the ids in the
+        order they were dumped.
+    """
+    def __init__(self, data):
+        if len(data) < _query_header.size:
+            raise ValueError('not a compiled query file')
+        magic, version, count, string_count = _query_header.unpack_from(data)
+        if magic != QUERY_MAGIC:
+            raise ValueError('not a compiled query file')
+        if version != QUERY_VERSION:
+            raise ValueError('unsupported compiled query file version %d' % version)
+        self.data = data
+        offset = _query_header.size
+        self.record_offsets = _unpack('I', data, offset, count + 1)
+        offset += 4 * (count + 1)
+        self.string_offsets = _unpack('I', data, offset, string_count + 1)
+        self.records_base = offset + 4 * (string_count + 1)
+        self.strings_base = self.records_base + self.record_offsets[-1]
+        self.strings = {}
+        self.programs = {}
+        self.positions = None # id -> record number, built on the first lookup by id
+
+    def string(self, i):
+        s = self.strings.get(i)
+        if s is None:
+            beg = self.strings_base + self.string_offsets[i]
+            end = self.strings_base + self.string_offsets[i+1]
+            s = self.strings[i] = self.data[beg:end].decode('utf-8')
+        return s
+
+    def _header(self, i):
+        kind, query_id, op_count, leaf_count = _query_record.unpack_from(
+            self.data, self.records_base + self.record_offsets[i])
+        if kind:
+            query_id = self.string(query_id)
+        return query_id, op_count, leaf_count
+
+    def id(self, i):
+        return self._header(i)[0]
+
+    def program(self, i):
+        """ the Program for the i'th query """
+        program = self.programs.get(i)
+        if program is not None:
+            return program
+        query_id, op_count, leaf_count = self._header(i)
+        offset = self.records_base + self.record_offsets[i] + _query_record.size
+        program = Program.__new__(Program)
+        program.traced = False
+        program.nodes = []
+        program.stamps = []
+        program.ops = _unpack('B', self.data, offset, op_count).tolist()
+        offset += op_count
+        program.args = _unpack('i', self.data, offset, op_count).tolist()
+        offset += 4 * op_count
+        leaves = _unpack('I', self.data, offset, 3 * leaf_count).tolist()
+        program.leaves = [Token(tagstr(self.string(leaves[j]), lineno=int(leaves[j+1]), char=int(leaves[j+2])))
+                          for j in xrange(0, len(leaves), 3)]
+        program.wildcards = sum(leaf.prefix is not None for leaf in program.leaves)
+        return self.programs.setdefault(i, program)
+
+    def __len__(self):
+        return len(self.record_offsets) - 1
+
+    def __iter__(self):
+        return (self.id(i) for i in xrange(len(self)))
+
+    def __contains__(self, query_id):
+        return self._position(query_id) is not None
+
+    def _position(self, query_id):
+        if self.positions is None:
+            self.positions = dict((self.id(i), i) for i in xrange(len(self)))
+        return self.positions.get(query_id)
+
+    def __getitem__(self, query_id):
+        i = self._position(query_id)
+        if i is None:
+            raise KeyError(query_id)
+        return self.program(i)
+
+    def items(self):
+        return [(self.id(i), self.program(i)) for i in xrange(len(self))]
+
+def load_queries(path):
+    """ open a compiled query file written by dump_queries(), memory mapped """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return QueryFile(data)
+
+class CompactQueries(object):
+    """ many compiled queries packed into a few flat arrays, for when there
+        are too many to keep each as a tree of objects.  Every query's
+        Program is appended to one opcode table (ops) and one operand table
+        (args), query i running from starts[i] to starts[i+1].  Jumps are
+        absolute and an OP_TERM's operand is its string's slot in the one
+        table of term strings shared by every query.  Source positions are
+        not kept.
+    """
+    def __init__(self, queries=()):
+        self.ids = []
+        self.positions = {} # id -> query number
+        self.starts = array('i', [0])
+        self.ops = array('B')
+        self.args = array('i')
+        self.strings = [] # the term strings
+        self.string_ids = {} # string -> slot in strings
+        self.terms = [] # the Term for each string, looked up on first use
+        for query_id, query in queries:
+            self.add(query_id, query)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, query_id):
+        return query_id in self.positions
+
+    def add(self, query_id, query):
+        """ add a pattern (lowercased, like PatternSet), tree or untraced Program """
+        if isinstance(query, basestring):
+            query = make_parse_tree(query.lower())
+        program = query if isinstance(query, Program) else query.compile()
+        if program.traced:
+            raise ValueError("traced programs can't be packed")
+        base = len(self.ops)
+        for op, arg in it.izip(program.ops, program.args):
+            if op == OP_TERM:
+                arg = self._string_id(program.leaves[arg].string)
+            elif op == OP_JUMP_FALSE or op == OP_JUMP_TRUE:
+                arg += base
+            self.ops.append(op)
+            self.args.append(arg)
+        self.starts.append(len(self.ops))
+        self.positions[query_id] = len(self.ids)
+        self.ids.append(query_id)
+
+    def _string_id(self, string):
+        string = unicode(string)
+        slot = self.string_ids.get(string)
+        if slot is None:
+            slot = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+            self.terms.append(None)
+        return slot
+
+    def term(self, slot):
+        term = self.terms[slot]
+        if term is None:
+            term = self.terms[slot] = intern_term(self.strings[slot])
+        return term
+
+    def evaluate(self, i, term_matches):
+        """ evaluate the i'th query with term_matches(string slot) deciding
+            each term, the same loop as Program.evaluate()
+        """
+        ops, args = self.ops, self.args
+        register = True
+        pc, end = self.starts[i], self.starts[i+1]
+        while pc < end:
+            op = ops[pc]
+            if op == OP_TERM:
+                register = term_matches(args[pc])
+            elif op == OP_JUMP_FALSE:
+                if not register:
+                    pc = args[pc]
+                    continue
+            elif op == OP_JUMP_TRUE:
+                if register:
+                    pc = args[pc]
+                    continue
+            elif op == OP_NOT:
+                register = not register
+            else:
+                register = op == OP_TRUE
+            pc += 1
+        return bool(register)
+
+    def matches(self, query_id, text):
+        text = text.lower()
+        fold = _Fold(text)
+        return self.evaluate(self.positions[query_id], lambda slot: self.term(slot).matches(text, None, fold))
+
+    def match(self, text):
+        """ return the ids of every query that matches text, each term is
+            looked for at most once
+        """
+        contains = _Prefixes(text.lower())
+        found = {}
+        def term_matches(slot):
+            hit = found.get(slot)
+            if hit is None:
+                hit = found[slot] = contains(self.term(slot))
+            return hit
+        return [query_id for i, query_id in enumerate(self.ids) if self.evaluate(i, term_matches)]
+
+# corpus index files: a header, then the sorted vocabulary, a postings record
+# per word and the text of the documents.  All integers little endian.
+#   header  magic 'BMCI', version H, document count I, word count I,
+#           irregular count I, then where the word, record and text tables
+#           and the irregular doc numbers (i each) start Q * 4
+#   table   (count + 1) offsets Q relative to the end of the offsets, then
+#           the items back to back
+#   record  doc count i, doc numbers i * doc count, (doc count + 1) offsets i
+#           into the positions, word positions i (nth word of the document)
+CORPUS_MAGIC = 'BMCI'
+CORPUS_VERSION = 1
+_corpus_header = struct.Struct('<4sHIIIQQQQ')
+
+# the only characters that lowercase to ascii word characters, so they can
+# change the words of a lowercased text
+_irregular_re = re.compile(u'[\u0130\u212a]')
+
+def _table(items):
+    offsets = [0]
+    for item in items:
+        offsets.append(offsets[-1] + len(item))
+    return ''.join([struct.pack('<%dQ' % len(offsets), *offsets)] + items)
+
+def dump_corpus_index(documents, fileobj):
+    """ index documents, unicode or ascii strings numbered from 0 in order,
+        and write the index and the documents to an open binary file.  The
+        words are runs of the ascii word characters the term regexes use.
+    """
+    postings = {} # word -> ([doc numbers], [[word positions] for each doc])
+    texts = []
+    irregular = []
+    for n, text in enumerate(documents):
+        text = unicode(text)
+        texts.append(text.encode('utf-8'))
+        if _irregular_re.search(text):
+            irregular.append(n)
+        positions = {}
+        for i, word in enumerate(_word_re.findall(text)):
+            positions.setdefault(word.lower(), []).append(i)
+        for word, where in positions.iteritems():
+            docs, doc_positions = postings.setdefault(word, ([], []))
+            docs.append(n)
+            doc_positions.append(where)
+
+    vocab = sorted(postings)
+    records = []
+    for word in vocab:
+        docs, doc_positions = postings[word]
+        offsets = [0]
+        for where in doc_positions:
+            offsets.append(offsets[-1] + len(where))
+        records.append(''.join([struct.pack('<i', len(docs)), _pack('i', docs), _pack('i', offsets),
+                                _pack('i', it.chain.from_iterable(doc_positions))]))
+    tables = [_table([str(word) for word in vocab]), _table(records), _table(texts), _pack('i', irregular)]
+    starts = [_corpus_header.size]
+    for table in tables[:-1]:
+        starts.append(starts[-1] + len(table))
+    fileobj.write(_corpus_header.pack(CORPUS_MAGIC, CORPUS_VERSION, len(texts), len(vocab), len(irregular),
+                                      *starts))
+    for table in tables:
+        fileobj.write(table)
+
+def _intersect(a, b):
+    """ the docs in both sorted lists, skipping through the longer one by
+        binary search so it costs O(short * log(long))
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    found = []
+    lo, end = 0, len(b)
+    for doc in a:
+        lo = bisect_left(b, doc, lo)
+        if lo == end:
+            break
+        if b[lo] == doc:
+            found.append(doc)
+    return found
+
+def _difference(a, b):
+    """ the docs in sorted list a that aren't in sorted list b """
+    found = []
+    lo, end = 0, len(b)
+    for doc in a:
+        lo = bisect_left(b, doc, lo)
+        if lo == end or b[lo] != doc:
+            found.append(doc)
+    return found
+
+def _union(lists):
+    if len(lists) == 1:
+        return lists[0]
+    return sorted(set().union(*lists))
+
+class CorpusIndex(object):
+    """ an inverted index of documents written by dump_corpus_index(), read
+        lazily from data, a string or an mmap.  search(query) gives the
+        numbers of the documents a query matches, the same ones
+        tree.matches() would, working on sorted postings lists instead of
+        looking at every document.
+        Terms that are one word, or a word prefix with a '*', are answered
+        by the postings alone.  Other terms (phrases, words with symbols)
+        are narrowed down with the word positions and then checked against
+        the stored text.  Terms with no ascii word characters at all, and
+        NOTs with nothing to subtract them from, have to look at every
+        document.  The few documents whose words change when lowercased
+        are rechecked when searching with a pattern.
+    """
+    def __init__(self, data):
+        if len(data) < _corpus_header.size:
+            raise ValueError('not a corpus index')
+        header = _corpus_header.unpack_from(data)
+        magic, version, self.count, word_count, irregular_count = header[:5]
+        if magic != CORPUS_MAGIC:
+            raise ValueError('not a corpus index')
+        if version != CORPUS_VERSION:
+            raise ValueError('unsupported corpus index version %d' % version)
+        self.data = data
+        words, self.records, self.texts, irregular = header[5:]
+        self.vocab = list(self._items(words, word_count))
+        # documents whose words change when they're lowercased
+        self.irregular = _unpack('i', data, irregular, irregular_count)
+
+    def __len__(self):
+        return self.count
+
+    def _item(self, table, count, i):
+        beg, end = struct.unpack_from('<2Q', self.data, table + 8 * i)
+        base = table + 8 * (count + 1)
+        return self.data[base + beg:base + end]
+
+    def _items(self, table, count):
+        offsets = struct.unpack_from('<%dQ' % (count + 1), self.data, table)
+        base = table + 8 * (count + 1)
+        data = self.data
+        for i in xrange(count):
+            yield data[base + offsets[i]:base + offsets[i+1]]
+
+    def text(self, doc):
+        return self._item(self.texts, self.count, doc).decode('utf-8')
+
+    def _record(self, word):
+        """ (doc numbers, where the record starts) for word, or None """
+        i = bisect_left(self.vocab, word)
+        if i == len(self.vocab) or self.vocab[i] != word:
+            return None
+        beg, = struct.unpack_from('<Q', self.data, self.records + 8 * i)
+        beg += self.records + 8 * (len(self.vocab) + 1)
+        count, = struct.unpack_from('<i', self.data, beg)
+        return _unpack('i', self.data, beg + 4, count), beg
+
+    def postings(self, word):
+        """ the sorted numbers of the documents word is in """
+        record = self._record(word.lower())
+        return [] if record is None else record[0]
+
+    def positions(self, word, doc):
+        """ which words of document doc are word """
+        return self._positions(self._record(word.lower()), doc)
+
+    def _positions(self, record, doc):
+        if record is None:
+            return []
+        docs, beg = record
+        i = bisect_left(docs, doc)
+        if i == len(docs) or docs[i] != doc:
+            return []
+        offsets = beg + 4 + 4 * len(docs)
+        first, last = struct.unpack_from('<2i', self.data, offsets + 4 * i)
+        return _unpack('i', self.data, offsets + 4 * (len(docs) + 1) + 4 * first, last - first)
+
+    def prefixed(self, prefix):
+        """ the words in the corpus that start with prefix """
+        vocab = self.vocab
+        words = []
+        for i in xrange(bisect_left(vocab, prefix), len(vocab)):
+            if not vocab[i].startswith(prefix):
+                break
+            words.append(vocab[i])
+        return words
+
+    def search(self, query):
+        """ the sorted numbers of the documents that match query, a pattern
+            (lowercased along with the text, like matches()) or a tree
+        """
+        lower = isinstance(query, basestring)
+        tree = tree_cache.get(query.lower()) if lower else query
+        check = lambda leaf, doc: leaf.matches(self.text(doc).lower() if lower else self.text(doc))
+        # each value is (docs, negated, leaves) and means the docs, or all
+        # the other docs if negated, that also match all of leaves.  None
+        # for docs is every document.
+        values = []
+        for node in postorder(tree):
+            if isinstance(node, AND):
+                n = len(node.parts)
+                parts = values[len(values)-n:]
+                del values[len(values)-n:]
+                if isinstance(node, OR):
+                    values.append(self._or([self._exact(part, check) for part in parts]))
+                else:
+                    values.append(self._and(parts, check))
+            elif isinstance(node, NOT):
+                docs, negated = self._exact(values.pop(), check)
+                values.append((docs, not negated, ()))
+            else:
+                values.append(self._leaf(node))
+        docs, negated = self._exact(values[0], check)
+        if negated:
+            docs = _difference(xrange(self.count), docs)
+        if lower and self.irregular:
+            found = set(docs)
+            for doc in self.irregular:
+                if tree.matches(self.text(doc).lower()):
+                    found.add(doc)
+                else:
+                    found.discard(doc)
+            docs = sorted(found)
+        return list(docs)
+
+    def _exact(self, value, check):
+        """ turn a value into (docs, negated) by checking its leaves """
+        docs, negated, leaves = value
+        if not leaves:
+            return docs, negated
+        if docs is None:
+            docs = xrange(self.count)
+        return [doc for doc in docs if all(check(leaf, doc) for leaf in leaves)], negated
+
+    def _and(self, parts, check):
+        lists = [docs for docs, negated, leaves in parts if not negated and docs is not None]
+        leaves = [leaf for docs, negated, part_leaves in parts for leaf in part_leaves]
+        negated = [docs for docs, negated, part_leaves in parts if negated]
+        if not lists and not leaves: # only NOTs: NOT (a OR b ...)
+            return _union(negated) if negated else [], True, ()
+        if lists:
+            lists.sort(key=len)
+            docs = lists[0]
+            for other in lists[1:]:
+                docs = _intersect(docs, other)
+        else:
+            docs = xrange(self.count)
+        if negated:
+            docs = _difference(docs, _union(negated))
+        return docs, False, tuple(leaves)
+
+    def _or(self, parts):
+        positive = [docs for docs, negated in parts if not negated]
+        negated = [docs for docs, negated in parts if negated]
+        if not negated:
+            return _union(positive) if positive else [], False, ()
+        # a OR NOT b OR NOT c == NOT ((b AND c) - a)
+        docs = negated[0]
+        for other in negated[1:]:
+            docs = _intersect(docs, other)
+        if positive:
+            docs = _difference(docs, _union(positive))
+        return docs, True, ()
+
+    def _leaf(self, leaf):
+        term = getattr(leaf, 'term', None)
+        if term is None:
+            return None, False, (leaf,)
+        if term.prefix is not None:
+            return _union([self._record(word)[0] for word in self.prefixed(term.prefix)] or [[]]), False, ()
+        string = term.string
+        literal = string.rstrip('*') if string.endswith('*') else string
+        words = [m for m in _word_re.finditer(literal)]
+        if not words:
+            return None, False, (leaf,)
+        if len(words) == 1 and words[0].group() == literal:
+            return self.postings(literal), False, ()
+        # the words of a term are whole words of the text, next to each other,
+        # except that the last can be a prefix if the term is a wildcard
+        slots = [[m.group().lower()] for m in words]
+        if literal != string and words[-1].end() == len(literal):
+            slots[-1] = self.prefixed(slots[-1][0])
+        records = [[record for record in map(self._record, slot) if record is not None] for slot in slots]
+        lists = [_union([record[0] for record in slot]) if slot else [] for slot in records]
+        docs = reduce(_intersect, sorted(lists, key=len))
+        candidates = []
+        for doc in docs:
+            starts = None
+            for i, slot in enumerate(records):
+                here = set()
+                for record in slot:
+                    here.update(pos - i for pos in self._positions(record, doc))
+                starts = here if starts is None else starts & here
+                if not starts:
+                    break
+            if starts:
+                candidates.append(doc)
+        return candidates, False, (leaf,)
+
+def load_corpus_index(path):
+    """ open a corpus index written by dump_corpus_index(), memory mapped """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return CorpusIndex(data)
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions maxsize currsize')
+
+class TreeCache(object):
+    """ a thread-safe LRU cache of parse trees keyed by pattern.
+        A maxsize of zero turns caching off.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.trees = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        self.profiler = None
+
+    def get(self, pattern):
+        with self.lock:
+            tree = self.trees.pop(pattern, None)
+            if tree is not None:
+                self.trees[pattern] = tree # move to the most recently used end
+                self.hits += 1
+                return tree
+            self.misses += 1
+        # parse outside the lock, bad patterns raise and are never cached
+        tree = make_parse_tree(pattern)
+        with self.lock:
+            if self.profiler is not None:
+                tree.profile = self.profiler.query(pattern)
+            self.trees[pattern] = tree
+            self._trim()
+        return tree
+
+    def set_profiler(self, profiler):
+        """ profile every tree the cache hands out with profiler, a
+            Profiler, or stop profiling with None
+        """
+        with self.lock:
+            self.profiler = profiler
+            for pattern, tree in self.trees.items():
+                tree.profile = None if profiler is None else profiler.query(pattern)
+
+    def _trim(self):
+        while len(self.trees) > self.maxsize:
+            self.trees.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self._trim()
+
+    def clear(self):
+        with self.lock:
+            self.trees.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.trees))
+
+    def __len__(self):
+        return len(self.trees)
+
+tree_cache = TreeCache()
+
+def matches(pattern, text, budget=None):
+    return tree_cache.get(pattern.lower()).matches(text.lower(), budget)
+
+class StreamMatcher(object):
+    """ match one pattern against text that arrives in chunks, without ever
+        holding more than a chunk and a short tail of the text before it.
+        feed() returns True or False as soon as the boolean structure
+        decides the match, e.g. an OR with a part already found, and None
+        while it is still open.  close() says there is no more text and
+        always returns the final answer.
+        Given a pattern string the pattern and the chunks are lowercased
+        like matches(), given a tree they are used as is like tree.matches().
+    """
+    def __init__(self, pattern):
+        self.lower = isinstance(pattern, basestring)
+        self.tree = tree_cache.get(pattern.lower()) if self.lower else pattern
+        self.pending = set(token.term for token in tree_tokens(self.tree))
+        self.found = set()
+        # a term that touches the end of the text so far might be cut off, so
+        # keep enough to see it again, plus one character of left context
+        self.keep = max([len(term.string) for term in self.pending] or [0]) + 1
+        self.tail = ''
+        self.started = False
+        self.result = self._decide(final=False)
+
+    def feed(self, chunk):
+        if self.result is None and chunk:
+            self._scan(chunk, final=False)
+        return self.result
+
+    def close(self):
+        if self.result is None:
+            self._scan('', final=True)
+        return self.result
+
+    def _scan(self, chunk, final):
+        if self.lower:
+            chunk = chunk.lower()
+        text = self.tail + chunk
+        start = 1 if self.started else 0 # text[0] is only left context
+        end = len(text)
+        fold = _Fold(text)
+        for term in list(self.pending):
+            for beg, stop in term._spans(text, start, fold):
+                if final or stop < end:
+                    self.found.add(term)
+                    break
+        self.pending.difference_update(self.found)
+        if len(text) > self.keep:
+            self.tail = text[-self.keep:]
+            self.started = True
+        else:
+            self.tail = text
+        self.result = self._decide(final)
+
+    def _decide(self, final):
+        """ evaluate the tree with pending terms unknown (None) unless final """
+        unknown = False if final else None
+        values = []
+        for node in postorder(self.tree):
+            if isinstance(node, AND):
+                n = len(node.parts)
+                parts = values[len(values)-n:]
+                del values[len(values)-n:]
+                if isinstance(node, OR):
+                    value = True if True in parts else (None if None in parts else False)
+                else:
+                    value = False if False in parts else (None if None in parts else True)
+            elif isinstance(node, NOT):
+                value = values.pop()
+                value = None if value is None else not value
+            else:
+                value = True if node.term in self.found else unknown
+            values.append(value)
+        return values[0]
+
+def matches_stream(pattern, source, chunksize=64 * 1024):
+    """ like matches() but for text read from a file-like object (or an
+        mmap) or given as an iterable of chunks.  Stops reading as soon as
+        the answer is known.
+    """
+    matcher = StreamMatcher(pattern)
+    chunks = source
+    if hasattr(source, 'read'):
+        chunks = iter(lambda: source.read(chunksize), source.read(0))
+    for chunk in chunks:
+        if matcher.feed(chunk) is not None:
+            return matcher.result
+    return matcher.close()
+
+def pprint_tree(node, indent=0, trace=None):
+    """ print the tree, with what each node evaluated to if given a Trace """
+    stack = [(node, indent)]
+    while stack:
+        node, indent = stack.pop()
+        value = node.last if trace is None else trace[node]
+        print ' ' * indent * 2, str(value)[0], node.word
+        stack.extend((part, indent+1) for part in reversed(getattr(node, 'parts', [])))
 
 
 if __name__ == '__main__':
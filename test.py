@@ -1,6 +1,15 @@
+import re
+import pickle
 import unittest
 import string
 from boolmatch import combine_ors, tokenize, tagstr, _tagstr, make_parse_tree, AND, OR, NOT, Token, matches, ParseException
+from boolmatch import TreeCache, tree_cache, PatternSet, Automaton, intern_term, DocumentIndex
+from boolmatch import optimize, TermStats, Program, postorder, _lex, WORD, OPEN, CLOSE, match_many, MatchService
+from boolmatch import OP_JUMP_FALSE, OP_JUMP_TRUE, OP_MARK
+from boolmatch import dumps_queries, dump_queries, load_queries, QueryFile
+from boolmatch import StreamMatcher, matches_stream, QueryProfile, Profiler, CompactQueries
+from boolmatch import make_regex, term_paths, Budget, BudgetExceeded
+from boolmatch import dump_corpus_index, load_corpus_index, CorpusIndex, IncrementalParser, tree_tokens
 
 class SimpleFilterTestCase(unittest.TestCase):
     def T(self, filter_string, text):
@@ -167,6 +176,138 @@ class TestAndParser(unittest.TestCase):
         # new parser is more robust
         self.assertTrue(make_parse_tree(' OR '.join(map(str, range(2000)))).matches('999'))
         self.assertTrue(make_parse_tree('%s Hi %s' % ('(' * 100, ')' * 100)).matches('hi'))
+        # no recursion limits
+        deep = make_parse_tree('%s Hi %s' % ('(' * 5000, ')' * 5000))
+        self.assertTrue(deep.matches('hi'))
+        self.assertEqual(deep.pretty(), 'AND Hi')
+        nots = make_parse_tree('NOT (' * 2001 + 'hi' + ')' * 2001)
+        self.assertFalse(nots.matches('hi'))
+        self.assertTrue(nots.matches('bye'))
+
+    def test_errors(self):
+        def error(pattern):
+            try:
+                make_parse_tree(pattern)
+            except ParseException as e:
+                return e.msg, e.loc
+        self.assertEqual(error('  a)'), ('mismatched closing parenthesis at character 1', 1))
+        self.assertEqual(error('(a (b) "c'), ('mismatched quotes starting at character 7', 7))
+        self.assertEqual(error('(a (b)'), ('mismatched parenthesis starting at character 0', 0))
+        self.assertEqual(error('a\nNOT'), ('trailing NOT on line 1', 0))
+        self.assertEqual(error('a OR'), ('bare OR at beginning of terms', 0))
+        self.assertEqual(error('OR a'), ('bare OR at end of terms line 0', 0))
+        self.assertEqual(error('(a OR) NOT'), ('trailing NOT on line 0', 0))
+        self.assertEqual(error('a *NOT'), ('trailing NOT on line 0', 0))
+        # the same errors, in the same order, as the original recursive parser
+        self.assertEqual(error('NOT NOT & () or or'), ('trailing NOT on line 0', 0))
+        self.assertEqual(error('not \n not'), ('trailing NOT on line 0', 0))
+        self.assertEqual(error('AND or hi NOT OR'), ('bare OR at beginning of terms', 0))
+        self.assertEqual(error('and or ( or )'), ('bare OR at beginning of terms', 0))
+        self.assertEqual(error('*NOT or b'), ('bare OR at beginning of terms', 0))
+        self.assertEqual(error('( or * )'), ('bare OR at beginning of terms', 0))
+
+    def test_keyword_operands(self):
+        # the words either side of an OR are its operands, even keywords,
+        # as they were in the original parser
+        self.assertEqual(make_parse_tree('a or or').pretty(), 'AND (a OR or)')
+        self.assertEqual(make_parse_tree('hi or or mom').pretty(), 'AND (hi OR (or AND mom))')
+        self.assertEqual(make_parse_tree('x or and').pretty(), 'AND (x OR and)')
+        self.assertEqual(make_parse_tree('b and or i').pretty(), 'AND ((b AND and) OR i)')
+        self.assertEqual(make_parse_tree('( and or * and and )').pretty(), 'AND (and OR and)')
+        self.assertTrue(matches('b and or i', 'i'))
+        self.assertFalse(matches('b and or i', 'b'))
+        self.assertTrue(matches('b and or i', 'b and'))
+        # a NOT's operand keeps its own position
+        tokens = list(tree_tokens(make_parse_tree('x NOT\n  foo')))
+        self.assertEqual([(t.word.lineno, t.word.char) for t in tokens], [(0, 0), (1, 8)])
+
+    def test_program(self):
+        # a AND (b OR c): the AND jumps past b OR c when a fails
+        program = Program(make_parse_tree('a (b or c)'))
+        self.assertEqual([leaf.string for leaf in program.leaves], ['a', 'b', 'c'])
+        seen = []
+        def term_matches(leaf):
+            seen.append(leaf.string)
+            return leaf.string != 'a'
+        self.assertFalse(program.evaluate(term_matches))
+        self.assertEqual(seen, ['a'])
+        self.assertTrue(make_parse_tree('a (b or c)').evaluate(lambda leaf: leaf.string != 'b'))
+        # a failing 'a' jumps straight past the AND that holds it
+        program = Program(make_parse_tree('(a b) or c'))
+        self.assertEqual([op for op in program.ops if op in (OP_JUMP_FALSE, OP_JUMP_TRUE)],
+                         [OP_JUMP_FALSE, OP_JUMP_TRUE])
+        self.assertEqual(program.args[1], 4)
+        self.assertFalse(OP_MARK in program.ops)
+
+    def test_edited(self):
+        # changing a compiled tree by hand compiles it again
+        tree = make_parse_tree('a (b or c)')
+        self.assertTrue(tree.matches('a c'))
+        tree.parts[:] = [Token(tagstr('b'))]
+        self.assertTrue(tree.matches('b'))
+        tree.parts.append(Token(tagstr('d')))
+        self.assertFalse(tree.matches('b'))
+        outer = AND([NOT(tree)])
+        self.assertTrue(outer.matches('b'))
+        outer.parts[0].tree = Token(tagstr('b'))
+        self.assertFalse(outer.matches('b'))
+        self.assertTrue(tree.trace('b d').result)
+        program = tree.compile()
+        self.assertTrue(make_parse_tree('x') and tree.compile() is program)
+        # only the trees an edit is in compile again
+        cached = tree_cache.get('hi (mom or dad)')
+        program, traced = cached.compile(), cached.trace('hi').values
+        private = make_parse_tree('hi (mom or dad)')
+        private.parts[1].parts.append(Token(tagstr('hi')))
+        self.assertTrue(private.matches('hi'))
+        self.assertTrue(cached.compile() is program and cached._traced is not None)
+        self.assertFalse(cached.matches('hi'))
+        # including trees that share the edited node
+        shared = AND([tree, Token(tagstr('b'))])
+        self.assertTrue(shared.matches('b d'))
+        tree.parts.pop()
+        self.assertTrue(shared.matches('b') and tree.matches('b'))
+
+    def test_pickle(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            word = pickle.loads(pickle.dumps(tagstr(u'mom', lineno=2, char=5), protocol))
+            self.assertEqual((word, word.lineno, word.char), (u'mom', 2, 5))
+            for pattern in [u'a OR "b c"', u'hi (mom or not dad*)']:
+                tree = make_parse_tree(pattern)
+                copy = pickle.loads(pickle.dumps(tree, protocol))
+                self.assertEqual(copy.pretty(), tree.pretty())
+                self.assertEqual([(t.string, t.string.lineno, t.string.char) for t in postorder(copy) if isinstance(t, Token)],
+                                 [(t.string, t.string.lineno, t.string.char) for t in postorder(tree) if isinstance(t, Token)])
+                self.assertEqual(copy.matches('hi mom'), tree.matches('hi mom'))
+            lexemes = pickle.loads(pickle.dumps(list(_lex(tagstr('a (b)'))), protocol))
+            self.assertEqual([(l.kind, l.text, l.char) for l in lexemes], [(l.kind, l.text, l.char) for l in _lex(tagstr('a (b)'))])
+
+    def test_trace(self):
+        tree = make_parse_tree('(a b) or (c not d)')
+        self.assertTrue(tree.matches('c'))
+        self.assertEqual(tree.last, '?') # evaluating doesn't touch the tree
+        trace = tree.trace('c d')
+        self.assertFalse(trace.result)
+        a_and_b, c_not_d = tree.parts[0].parts
+        self.assertEqual([trace[node] for node in a_and_b.parts], [False, '?'])
+        self.assertEqual([trace[tree], trace[a_and_b], trace[c_not_d]], [False, False, False])
+        self.assertEqual([trace[c_not_d.parts[0]], trace[c_not_d.parts[1]]], [True, False])
+
+    def test_threads(self):
+        import threading
+        tree = make_parse_tree('(hi mom) or (bye not dad)')
+        texts = [('hi mom', True), ('bye', True), ('bye dad', False), ('hi', False)] * 200
+        failures = []
+        def check():
+            for text, expected in texts:
+                if tree.matches(text) != expected:
+                    failures.append(text)
+        threads = [threading.Thread(target=check) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
 
 class TestParser(unittest.TestCase):
     def test_tokenize(self):
@@ -191,6 +332,12 @@ class TestParser(unittest.TestCase):
         self.assertEqual(both('abc\n123')[-1].char, 4)
         self.assertEqual(both('abc\n123')[-1].lineno, 1)
 
+    def test_lex(self):
+        lexemes = list(_lex(tagstr('a(b "c) d")\ne', char=10)))
+        self.assertEqual([(l.kind, l.text, l.lineno, l.char) for l in lexemes],
+                         [(WORD, 'a', 0, 10), (OPEN, '(', 0, 11), (WORD, 'b', 0, 12),
+                          (WORD, '"c) d"', 0, 14), (CLOSE, ')', 0, 20), (WORD, 'e', 1, 22)])
+        self.assertFalse(hasattr(lexemes[0], '__dict__'))
 
     def test_parse_obs(self):
         class Yes(object):
@@ -229,5 +376,577 @@ class TestParser(unittest.TestCase):
         for p in ['(this)', '(this OR that)', 'this\nNOT that', '"bob smith"', bigquery, parens, parens2]:
             tree = make_parse_tree(p)
 
+class TestExplain(unittest.TestCase):
+    def hits(self, pattern, text):
+        return [(text[beg:end], token.string) for beg, end, token in make_parse_tree(pattern).find_matches(text)]
+
+    def test_find_matches(self):
+        self.assertEqual(self.hits('hi mom', 'Hi there, mom. hi!'), [('Hi', 'hi'), ('mom', 'mom'), ('hi', 'hi')])
+        self.assertEqual(self.hits('hive* or fire', 'hivefire and fire'), [('hive', 'hive*')])
+        self.assertEqual(self.hits('(hi and nope) or mom', 'hi mom'), [('mom', 'mom')])
+        self.assertEqual(self.hits('hi and not mom', 'hi there'), [('hi', 'hi')])
+        self.assertEqual(self.hits('hi and not mom', 'hi mom'), [])
+        self.assertEqual(self.hits('"cloud computing" X&Y', 'X&Y: cloud computing'),
+                         [('X&Y', 'X&Y'), ('cloud computing', 'cloud computing')])
+        self.assertEqual(self.hits(u'\u6c49', u'\u8bed \u6c49 \u6f22'), [(u'\u6c49', u'\u6c49')])
+        self.assertEqual(self.hits('not hi', 'mom'), [])
+
+    def test_explain(self):
+        tree = make_parse_tree('(a or b) and not c')
+        trace = tree.explain('a b')
+        self.assertTrue(trace.result)
+        a, b = tree.parts[0].parts
+        self.assertEqual(trace.hits, [(a, [(0, 1)])])
+        self.assertEqual(trace[b], '?')
+        for pattern in TestPatternSet.patterns:
+            tree = make_parse_tree(pattern)
+            for text in TestPatternSet.texts:
+                trace = tree.explain(text)
+                self.assertEqual(trace.result, tree.matches(text))
+                self.assertTrue(all(spans for token, spans in trace.hits))
+
+
+class TestProfile(unittest.TestCase):
+    def test_query_profile(self):
+        tree = make_parse_tree('hi or (mom and not dad)')
+        calls = []
+        tree.profile = QueryProfile(callback=lambda profile, text, result, seconds: calls.append((text, result)))
+        for text in ['hi', 'mom', 'mom dad', 'nope']:
+            self.assertEqual(tree.matches(text), matches('hi or (mom and not dad)', text))
+        profile = tree.profile
+        self.assertEqual(calls, [('hi', True), ('mom', True), ('mom dad', False), ('nope', False)])
+        self.assertEqual((profile.evaluations, profile.hits, profile.short_circuits), (4, 2, 2))
+        self.assertEqual(profile.hit_rate, 0.5)
+        self.assertTrue(profile.seconds > 0)
+        hi, mom, dad = profile.tokens
+        self.assertEqual([t.token.string for t in profile.tokens], ['hi', 'mom', 'dad'])
+        self.assertEqual((hi.evaluations, hi.hits, hi.short_circuits), (4, 1, 0))
+        self.assertEqual((mom.evaluations, mom.hits, mom.short_circuits), (3, 2, 1))
+        self.assertEqual((dad.evaluations, dad.hits, dad.short_circuits), (2, 1, 2))
+        self.assertEqual(dad.hit_rate, 0.5)
+        tree.profile = None
+        tree.matches('hi')
+        self.assertEqual(profile.evaluations, 4)
+
+    def test_recompiled(self):
+        tree = make_parse_tree('hi or (mom and dad)')
+        other = make_parse_tree('hi or mom')
+        tree.profile = profile = QueryProfile()
+        tree.matches('hi')
+        self.assertEqual(tree.pretty(), 'AND (hi OR (mom AND dad))')
+        tree.matches('mom dad')
+        other.parts[0].parts.append(Token(tagstr('dad')))
+        tree.matches('mom')
+        self.assertTrue(other.matches('dad'))
+        tree.matches('nope')
+        self.assertEqual(profile.evaluations, 4)
+        hi, mom, dad = profile.tokens
+        self.assertEqual([t.evaluations for t in profile.tokens], [4, 3, 2])
+        # editing the tree itself keeps the stats of the leaves still in it
+        tree.parts[0].parts[1].parts.pop()
+        tree.matches('mom')
+        self.assertEqual(profile.tokens, [hi, mom])
+        self.assertEqual([t.evaluations for t in profile.tokens], [5, 4])
+
+    def test_sample(self):
+        tree = make_parse_tree('hi')
+        tree.profile = QueryProfile(sample=3)
+        for i in range(10):
+            self.assertTrue(tree.matches('hi'))
+        self.assertEqual((tree.profile.calls, tree.profile.evaluations), (10, 3))
+
+    def test_profiler(self):
+        cache = TreeCache()
+        cache.get('hi')
+        profiler = Profiler()
+        cache.set_profiler(profiler)
+        cache.get('hi').matches('hi there')
+        cache.get('mom').matches('hi there')
+        self.assertEqual(sorted(profiler.queries), ['hi', 'mom'])
+        self.assertEqual([p.evaluations for pattern, p in profiler.top()], [1, 1])
+        self.assertEqual(len(profiler.top(1)), 1)
+        cache.set_profiler(None)
+        self.assertTrue(cache.get('hi').profile is None)
+
+
+class TestLiteralTerms(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(intern_term('Cloud').literal, 'cloud')
+        self.assertEqual(intern_term('Cloud Computing').literal, 'cloud computing')
+        self.assertEqual(intern_term('X&Y').literal, 'x&y')
+        for string in ['&', '.net', 'c++', 'hive*', u'caf\xe9', u'\u6c49', 'tab\tbed']:
+            self.assertEqual(intern_term(string).literal, None, msg=string)
+        paths = term_paths()
+        self.assertTrue(paths['literal'] >= 3 and paths['regex'] >= 7)
+
+    def test_same_as_regex(self):
+        texts = ['Cloud nine', 'cloudy', 'x cloud_', 'CLOUD', '(cloud)', u'\u212aelvin', u'KELVIN \u0130',
+                 u'\u0130 cloud', 'ab' * 20 + ' ab', 'the cloud cloud', 'X&Y&Z', 'x&y', '']
+        for string in ['cloud', 'kelvin', 'ab', 'cloud cloud', 'x&y', 'i']:
+            term, regex = intern_term(string), re.compile(make_regex(string), re.I)
+            for text in texts:
+                self.assertEqual(term.matches(text), bool(regex.search(text)), msg=(string, text))
+                self.assertEqual(term.spans(text), [m.span() for m in regex.finditer(text)], msg=(string, text))
+                for pos in range(len(text) + 1):
+                    self.assertEqual(term.match_at(text, pos), bool(regex.match(text, pos)), msg=(string, text, pos))
+        term = intern_term('zqxliteral')
+        self.assertTrue(term.matches('a Zqxliteral b') and term.match_at('Zqxliteral', 0))
+        self.assertFalse(term.compiled)
+
+    def test_folding(self):
+        import gc, weakref
+        class Text(unicode):
+            pass
+        tree = make_parse_tree('(cloud or data) "big data"')
+        text = Text(u'Big Data CLOUD')
+        self.assertTrue(tree.matches(text))
+        self.assertEqual(tree.find_matches(text), [(0, 8, tree.parts[1]), (9, 14, tree.parts[0].parts[0])])
+        # nothing holds on to the text once matching is done
+        ref = weakref.ref(text)
+        del text
+        gc.collect()
+        self.assertTrue(ref() is None)
+
+class TestBudget(unittest.TestCase):
+    def test_steps(self):
+        tree = make_parse_tree('a OR b OR c')
+        self.assertRaises(BudgetExceeded, tree.matches, 'c', Budget(steps=2))
+        self.assertTrue(tree.matches('c', Budget(steps=3)))
+        budget = Budget(steps=3) # shared by the calls
+        self.assertTrue(tree.matches('a', budget) and tree.matches('b', budget))
+        self.assertRaises(BudgetExceeded, tree.matches, 'a', budget)
+        self.assertTrue(matches('hive* or fire*', 'firefox', Budget(steps=2)))
+
+    def test_deadline(self):
+        self.assertRaises(BudgetExceeded, matches, 'a', 'a', Budget(seconds=-1))
+        self.assertTrue(matches('a', 'a', Budget(seconds=60)))
+
+    def test_candidates(self):
+        # the regex misses everywhere but the exact fallback has 50 places to check
+        text = u'ba\xe9 ' * 50
+        tree = make_parse_tree(u'a\xe9')
+        self.assertFalse(tree.matches(text, Budget(candidates=50)))
+        self.assertRaises(BudgetExceeded, tree.matches, text, Budget(candidates=49))
+        self.assertRaises(BudgetExceeded, tree.matches, text, Budget(steps=20))
+        tree.profile = QueryProfile()
+        self.assertRaises(BudgetExceeded, tree.matches, text, Budget(candidates=10))
+        pset = PatternSet([('x', u'a\xe9'), ('y', u'ba\xe9')])
+        self.assertEqual(pset.match(text, Budget(steps=100)), ['y'])
+        self.assertRaises(BudgetExceeded, pset.match, text, Budget(steps=10))
+
+class TestWildcards(unittest.TestCase):
+    def test_prefix(self):
+        self.assertEqual(intern_term('Hive*').prefix, 'hive')
+        self.assertEqual(intern_term('hive').prefix, None)
+        self.assertEqual(intern_term('x&*').prefix, None)
+        self.assertEqual(intern_term(u'\u0130*').prefix, None) # lowercases to an ascii i
+
+    def test_vocabulary(self):
+        tree = make_parse_tree('hive* or fire* or x&* one* not tw*')
+        self.assertEqual(tree.compile().wildcards, 4)
+        texts = TestPatternSet.texts + ['firefox', 'x&y', 'onetwo', 'one, two', 'One Three', u'\u0130VE']
+        for text in texts:
+            self.assertEqual(tree.matches(text), tree.evaluate(lambda leaf: leaf.term.matches(text)), text)
+        self.assertEqual(make_parse_tree('hive* or fire*').compile().wildcards, 2)
+        self.assertEqual(make_parse_tree('hive* fire').compile().wildcards, 1)
+
+    def test_stripped_stars(self):
+        # the backwards compatible handling of '*' is unchanged
+        self.assertEqual(tokenize('* hi*mom one*'), ['himom', 'AND', 'one*'])
+        self.assertEqual(make_parse_tree('(hive*)').compile().wildcards, 0)
+        tree = make_parse_tree('hi*mom or * or one*')
+        self.assertEqual([leaf.string for leaf in tree.compile().leaves], ['himom', 'one*'])
+        self.assertTrue(tree.matches('oneself'))
+
+
+class TestTreeCache(unittest.TestCase):
+    def test_lru(self):
+        cache = TreeCache(maxsize=2)
+        a = cache.get('a')
+        self.assertTrue(cache.get('a') is a)
+        cache.get('b')
+        cache.get('a') # 'b' is now the least recently used
+        cache.get('c')
+        self.assertEqual(sorted(cache.trees), ['a', 'c'])
+        self.assertEqual(cache.info(), (2, 3, 1, 2, 2))
+        cache.resize(1)
+        self.assertEqual(list(cache.trees), ['c'])
+        self.assertEqual(cache.info().evictions, 2)
+        cache.clear()
+        self.assertEqual(cache.info(), (0, 0, 0, 1, 0))
+
+    def test_disabled(self):
+        cache = TreeCache(maxsize=0)
+        self.assertFalse(cache.get('a') is cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_errors_not_cached(self):
+        cache = TreeCache()
+        self.assertRaises(ParseException, cache.get, '(a')
+        self.assertEqual(len(cache), 0)
+
+    def test_matches_uses_cache(self):
+        tree_cache.clear()
+        self.assertTrue(matches('Hi Mom', 'mom says hi'))
+        self.assertTrue(matches('hi mom', 'hi mom'))
+        self.assertEqual(tree_cache.info().hits, 1)
+
+class TestPatternSet(unittest.TestCase):
+    patterns = ['hivefire', 'hi mom', 'hi or mom', 'not mom', 'X&Y', '&', '|', '| or &', '"hi mom"',
+                '"hi and mom"', '(hi and mom) or hello', 'hive*', 'hive *fire', 'one* four',
+                "boar's head", '999', u'\u6c49', 'cloud', '"cloud computing"', 'not (a or b)',
+                'this', '"A B"', '"*"']
+    texts = ['Hivefire is awesome.', 'pbdHivefire is awesome', 'mom says hi', 'hi mom', 'bob & sue',
+             '&', '|', 'X&Y', 'hivefire', 'hive fire', 'one two three', "boar's head", '1 999 2',
+             u'\u8bed \u6c49 \u6f22', u'\u6c49\u8bed', 'cloud computing', 'THIS', 'a b', 'b', '']
+
+    def test_automaton(self):
+        found = sorted(Automaton(['he', 'she', 'his', 'hers']).scan('ushers'))
+        self.assertEqual(found, [(1, 'she'), (2, 'he'), (2, 'hers')])
+
+    def test_same_as_matches(self):
+        pset = PatternSet(enumerate(self.patterns))
+        self.assertEqual(len(pset), len(self.patterns))
+        for text in self.texts:
+            expected = [i for i, pattern in enumerate(self.patterns) if matches(pattern, text)]
+            self.assertEqual(pset.match(text), expected, msg=text)
+
+    def test_match_matrix(self):
+        pset = PatternSet(enumerate(self.patterns + ['', 'not ""']))
+        matrix = pset.match_matrix(iter(self.texts))
+        self.assertEqual(len(matrix), len(self.texts))
+        for text, row in zip(self.texts, matrix):
+            self.assertEqual([i for i, hit in enumerate(row) if hit], pset.match(text), msg=text)
+        bits = pset.match_bits(['mom', 'hi', 'hi mom'])
+        self.assertEqual(bits[2], 7) # hi or mom
+        self.assertEqual(bits[3], 2) # not mom
+        self.assertEqual(pset.match_matrix([]), [])
+        self.assertEqual(PatternSet().match_matrix(['a', 'b']), [[], []])
+
+    def test_trees(self):
+        # trees aren't lowercased when they are parsed but match() lowercases the text
+        trees = [make_parse_tree('Foo'), make_parse_tree('"Hi Mom" OR Hive*'), make_parse_tree(u'\xc9t\xe9')]
+        pset = PatternSet(enumerate(trees))
+        texts = ['foo', 'FOO bar', 'hi mom', 'Hivefire', u'\xc9t\xe9', 'nothing']
+        self.assertEqual([pset.match(text) for text in texts], [[0], [0], [1], [1], [2], []])
+        self.assertEqual(pset.match_bits(texts), [3, 12, 16])
+        self.assertEqual(list(match_many(trees, texts)), [pset.match(text) for text in texts])
+
+    def test_shared_terms(self):
+        pset = PatternSet([('a', 'cloud or rain'), ('b', 'cloud and sun'), ('c', 'not cloud')])
+        self.assertEqual(len(pset.terms), 3)
+        self.assertEqual(pset.match('Cloud with a chance of rain'), ['a'])
+        self.assertEqual(pset.match('sun'), ['c'])
+
+    def test_common_subexpressions(self):
+        pset = PatternSet([('a', '(x or y) and z'), ('b', 'w or (y or x)'), ('c', 'not (not (x or y))')])
+        # x, y, z, w, (x OR y), (x OR y) AND z, w OR (x OR y), NOT (x OR y)
+        self.assertEqual(len(pset.nodes), 8)
+        self.assertEqual(pset.nodes[pset.roots[2]], (2, (0, 1))) # 'c' is the shared (x OR y)
+        self.assertEqual(pset.match('x z'), ['a', 'b', 'c'])
+        self.assertEqual(pset.match('w'), ['b'])
+
+    def test_match_many(self):
+        texts = self.texts * 3
+        expected = [[i for i, pattern in enumerate(self.patterns) if matches(pattern, text)] for text in texts]
+        self.assertEqual(list(match_many(self.patterns, texts)), expected)
+        self.assertEqual(list(match_many(self.patterns, iter(texts), processes=2, chunksize=4)), expected)
+        unordered = match_many(self.patterns, texts, processes=2, chunksize=4, ordered=False)
+        self.assertEqual(sorted(unordered), list(enumerate(expected)))
+        named = match_many({'mom': 'mom', 'hi': 'hi'}, ['hi mom', 'hi', 'bye'])
+        self.assertEqual([sorted(ids) for ids in named], [['hi', 'mom'], ['hi'], []])
+
+    def test_match_service(self):
+        texts = self.texts * 3
+        expected = [[i for i, pattern in enumerate(self.patterns) if matches(pattern, text)] for text in texts]
+        trees = [make_parse_tree(pattern.lower()) for pattern in self.patterns]
+        with MatchService(trees, processes=2, max_pending=2, batch_size=4) as service:
+            self.assertEqual(list(service.match(iter(texts))), expected)
+            self.assertEqual(sorted(service.match(texts, ordered=False)), list(enumerate(expected)))
+            # documents are only pulled when there is room for them
+            pulled = []
+            def documents():
+                for text in texts:
+                    pulled.append(text)
+                    yield text
+            results = service.match(documents())
+            self.assertEqual(next(results), expected[0])
+            self.assertTrue(len(pulled) <= 3 * 4, len(pulled))
+            self.assertEqual(list(results), expected[1:])
+            # a batch that fails in a worker fails match()
+            for ordered in (True, False):
+                self.assertRaises(AttributeError, list, service.match(['hi', ['mom']], ordered=ordered))
+        self.assertTrue(service.pool is None)
+        inline = MatchService(self.patterns, processes=0)
+        self.assertEqual(list(inline.match(texts)), expected)
+        self.assertEqual([len(batch) for batch in MatchService([], 0, batch_size=3, batch_chars=10).batches(
+            ['a', 'b', 'c', 'd', 'x' * 20, 'e'])], [3, 2, 1])
+
+    def test_interned_terms(self):
+        tree = make_parse_tree('"cloud computing" or (cloud computing) or "cloud computing"')
+        tokens = tree.parts[0].parts
+        self.assertTrue(tokens[0].term is tokens[2].term)
+        self.assertTrue(tokens[0].regex is tokens[2].regex)
+        self.assertTrue(tokens[1].parts[0].term is intern_term(u'cloud'))
+        self.assertFalse(intern_term('cloud*') is intern_term('cloud'))
+
+class TestDocumentIndex(unittest.TestCase):
+    def test_same_as_matches(self):
+        trees = [make_parse_tree(p) for p in TestPatternSet.patterns]
+        for text in TestPatternSet.texts:
+            index = DocumentIndex(text)
+            for pattern, tree in zip(TestPatternSet.patterns, trees):
+                self.assertEqual(index.matches(tree), tree.matches(text), msg=(pattern, text))
+
+    def test_lookups(self):
+        index = DocumentIndex(u'The hive, the HIVEFIRE and the hi-fi')
+        self.assertEqual(index.words['the'], [0, 10, 27])
+        self.assertEqual(sorted(index.prefixed('hive')), [4, 14])
+        self.assertEqual(index.candidates(intern_term('the hive')), [0]) # via 'hive'
+        self.assertEqual(index.candidates(intern_term('the hi-fi')), [27])
+        self.assertTrue(index.contains(intern_term('hivef*')))
+        self.assertFalse(index.contains(intern_term('hivef')))
+        self.assertEqual(index.candidates(intern_term(',')), [8])
+
+class TestOptimize(unittest.TestCase):
+    def test_same_as_matches(self):
+        for pattern in TestPatternSet.patterns + ['a or ()', 'not ()', 'a and not (not (b or ()))']:
+            tree = make_parse_tree(pattern)
+            opt = optimize(tree)
+            for text in TestPatternSet.texts + ['a', 'a b']:
+                self.assertEqual(opt.matches(text), tree.matches(text), msg=(pattern, text))
+
+    def test_simplify(self):
+        self.assertEqual(optimize(make_parse_tree('a and not (not (b c))')).pretty(), '(a AND b AND c)')
+        self.assertEqual(optimize(make_parse_tree('a or (b or c) or a')).pretty(), 'AND (a OR b OR c)')
+        self.assertEqual(optimize(make_parse_tree('a or ()')).parts, [])
+        never = optimize(make_parse_tree('a and not ()'))
+        self.assertEqual(len(never.parts), 1)
+        self.assertTrue(isinstance(never.parts[0], OR) and not never.parts[0].parts)
+
+    def test_order(self):
+        stats = TermStats({'common': 0.9, 'rare': 0.01})
+        self.assertEqual(optimize(make_parse_tree('common rare'), stats).pretty(), '(rare AND common)')
+        self.assertEqual(optimize(make_parse_tree('rare or common'), stats).pretty(), 'AND (common OR rare)')
+        # learned stats win over the table
+        for text in ['rare', 'rare words', 'more rare words']:
+            stats.learn(make_parse_tree('common rare'), text)
+        self.assertEqual(stats.seen['rare'], 3)
+        self.assertEqual(optimize(make_parse_tree('common rare'), stats).pretty(), '(common AND rare)')
+
+class TestStream(unittest.TestCase):
+    def test_same_as_matches(self):
+        for pattern in TestPatternSet.patterns:
+            for text in TestPatternSet.texts:
+                expected = matches(pattern, text)
+                for size in [1, 2, 3, 7]:
+                    chunks = [text[i:i+size] for i in range(0, len(text), size)]
+                    self.assertEqual(matches_stream(pattern, chunks), expected, (pattern, text, size))
+
+    def test_early(self):
+        matcher = StreamMatcher('hivefire or mom')
+        self.assertEqual(matcher.feed('my hive'), None)
+        self.assertEqual(matcher.feed('fire'), None) # could still be hivefirewall
+        self.assertEqual(matcher.feed(' is'), True)
+        self.assertEqual(matcher.close(), True)
+        matcher = StreamMatcher(make_parse_tree('hi and not mom'))
+        self.assertEqual(matcher.feed('mom says'), False)
+        self.assertEqual(StreamMatcher('not ()').result, False) # decided before any text
+        self.assertEqual(StreamMatcher('hi').close(), False)
+
+    def test_files(self):
+        import mmap, tempfile
+        with tempfile.TemporaryFile() as f:
+            f.write('x' * 100000 + ' "cloud computing" ' + 'y' * 100000)
+            f.flush()
+            f.seek(0)
+            self.assertTrue(matches_stream('"cloud computing"', f, chunksize=1000))
+            f.seek(0)
+            self.assertFalse(matches_stream('cloud and not computing', f, chunksize=4096))
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.assertTrue(matches_stream('"cloud computing"', data, chunksize=1000))
+            self.assertTrue(data.tell() < 110000) # stopped reading once it knew
+            data.close()
+
+
+class TestCompactQueries(unittest.TestCase):
+    def test_same_as_matches(self):
+        patterns = TestPatternSet.patterns
+        queries = CompactQueries(enumerate(patterns))
+        self.assertEqual(len(queries), len(patterns))
+        for text in TestPatternSet.texts:
+            expected = [i for i, pattern in enumerate(patterns) if matches(pattern, text)]
+            self.assertEqual(queries.match(text), expected, text)
+            self.assertEqual([i for i in range(len(patterns)) if queries.matches(i, text)], expected)
+
+    def test_tables(self):
+        queries = CompactQueries([('a', 'hi or mom'), ('b', make_parse_tree('mom and not hi'))])
+        self.assertEqual(queries.strings, ['hi', 'mom'])
+        self.assertEqual(list(queries.starts), [0, 3, 7])
+        self.assertEqual(queries.terms, [None, None]) # nothing looked up yet
+        self.assertTrue('b' in queries and 'c' not in queries)
+        self.assertEqual(queries.match('MOM'), ['a', 'b'])
+        self.assertTrue(queries.terms[0] is intern_term('hi'))
+        self.assertRaises(ValueError, queries.add, 'c', Program(make_parse_tree('hi'), traced=True))
+
+    def test_slots(self):
+        tree = make_parse_tree('hi or not "cloud computing"')
+        token = tree.parts[0].parts[0]
+        for obj in [tree, tree.parts[0], tree.parts[0].parts[1], token, token.term, token.word, tree.compile()]:
+            self.assertFalse(hasattr(obj, '__dict__'), obj)
+        self.assertEqual(token.word.txt, 'hi')
+
+
+class TestCorpusIndex(unittest.TestCase):
+    texts = TestPatternSet.texts + ['hi  mom', 'Hi Mom', 'boars head', u'\u0130ve', u'\u0130VE hivefire']
+
+    def index(self, texts):
+        from StringIO import StringIO
+        f = StringIO()
+        dump_corpus_index(texts, f)
+        return CorpusIndex(f.getvalue())
+
+    def test_same_as_matches(self):
+        index = self.index(self.texts)
+        self.assertEqual(len(index), len(self.texts))
+        for pattern in TestPatternSet.patterns + ['not hi', 'hi or not mom', 'not hi and not mom', 'ive* or hive*',
+                                                  '"hi mom" or (one* and not "hive fire")', '()', 'not ()']:
+            expected = [i for i, text in enumerate(self.texts) if matches(pattern, text)]
+            self.assertEqual(index.search(pattern), expected, pattern)
+            tree = make_parse_tree(pattern)
+            expected = [i for i, text in enumerate(self.texts) if tree.matches(unicode(text))]
+            self.assertEqual(index.search(tree), expected, pattern)
+
+    def test_postings(self):
+        index = self.index(['hi mom', 'Mom, mom and hi', 'nothing'])
+        self.assertEqual(index.vocab, ['and', 'hi', 'mom', 'nothing'])
+        self.assertEqual(list(index.postings('MOM')), [0, 1])
+        self.assertEqual(list(index.positions('mom', 1)), [0, 1])
+        self.assertEqual(list(index.positions('mom', 2)), [])
+        self.assertEqual(list(index.postings('dad')), [])
+        self.assertEqual(index.prefixed('n'), ['nothing'])
+        self.assertEqual(index.text(1), 'Mom, mom and hi')
+
+    def test_files(self):
+        import os, tempfile
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                dump_corpus_index([u'\u6c49 hi', 'mom'], f)
+            index = load_corpus_index(path)
+            self.assertEqual(index.search(u'\u6c49 or mom'), [0, 1])
+            self.assertEqual(index.search('hi and not mom'), [0])
+            index.data.close()
+        finally:
+            os.remove(path)
+        self.assertRaises(ValueError, CorpusIndex, 'nope')
+        self.assertRaises(ValueError, CorpusIndex, 'XXXX' + self.index([]).data[4:])
+
+
+class TestQueryFile(unittest.TestCase):
+    patterns = TestPatternSet.patterns
+
+    def test_round_trip(self):
+        data = dumps_queries(enumerate(self.patterns))
+        queries = QueryFile(data)
+        self.assertEqual(list(queries), range(len(self.patterns)))
+        for i, pattern in enumerate(self.patterns):
+            tree = make_parse_tree(pattern)
+            program = queries[i]
+            self.assertEqual(program.ops, tree.compile().ops)
+            self.assertEqual(program.args, tree.compile().args)
+            self.assertEqual([(leaf.word, leaf.word.lineno, leaf.word.char) for leaf in program.leaves],
+                             [(leaf.word, leaf.word.lineno, leaf.word.char) for leaf in tree.compile().leaves])
+            for text in TestPatternSet.texts:
+                self.assertEqual(program.matches(text), tree.matches(text), (pattern, text))
+
+    def test_lazy(self):
+        queries = QueryFile(dumps_queries([('lazy', 'zqxlazy and "zqx lazier"'), ('other', make_parse_tree('hi'))]))
+        self.assertEqual(queries.programs, {})
+        self.assertTrue('other' in queries and 'nope' not in queries)
+        self.assertRaises(KeyError, lambda: queries['nope'])
+        program = queries['lazy']
+        self.assertTrue(program is queries['lazy'])
+        self.assertEqual([leaf.string for leaf in program.leaves], ['zqxlazy', 'zqx lazier'])
+        self.assertEqual(program.leaves[1].string.char, 13)
+        self.assertEqual(QueryFile(dumps_queries([(-1, 'x')])).id(0), -1)
+        self.assertFalse(any(leaf.term.compiled for leaf in program.leaves))
+        self.assertFalse(program.matches('zqxlazy'))
+        self.assertFalse(program.leaves[0].term.compiled) # a literal, found with str.find()
+        self.assertTrue(program.matches('zqxlazy zqx lazier'))
+        self.assertEqual(queries.items()[1][0], 'other')
+
+    def test_files(self):
+        import os, tempfile
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                dump_queries({u'\u6c49': u'\u6c49 or hi'}.items(), f)
+            queries = load_queries(path)
+            self.assertEqual(list(queries), [u'\u6c49'])
+            self.assertTrue(queries[u'\u6c49'].matches('hi there'))
+            queries.data.close()
+        finally:
+            os.remove(path)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, QueryFile, 'nope')
+        self.assertRaises(ValueError, QueryFile, 'XXXX' + dumps_queries([])[4:])
+        self.assertRaises(ValueError, QueryFile, 'BMQF\x09\x00' + dumps_queries([])[6:])
+        self.assertRaises(TypeError, dumps_queries, [(None, 'hi')])
+        self.assertRaises(ValueError, dumps_queries, [(2**31, 'hi')])
+        self.assertRaises(ValueError, dumps_queries, [(-2**31 - 1, 'hi')])
+        self.assertEqual(QueryFile(dumps_queries([(2**31 - 1, 'hi'), (-2**31, 'x')])).id(1), -2**31)
+        self.assertRaises(ValueError, dumps_queries, [(0, Program(make_parse_tree('hi'), traced=True))])
+
+
+class TestIncremental(unittest.TestCase):
+    def assertSameTree(self, parser, pattern):
+        tree, expected = parser.parse(pattern), make_parse_tree(pattern)
+        self.assertEqual(tree.pretty(), expected.pretty())
+        positions = lambda tree: [(leaf.word, leaf.word.lineno, leaf.word.char) for leaf in tree_tokens(tree)]
+        self.assertEqual(positions(tree), positions(expected))
+        return tree
+
+    def test_edits(self):
+        parser = IncrementalParser()
+        first = self.assertSameTree(parser, 'cloud OR (data AND mobile) NOT\n"x y" storage*')
+        edits = ['cloud OR (data AND mobile) NOT\n"x y" storage* growth',
+                 'cloud security OR (data AND mobile) NOT\n"x y" storage* growth',
+                 'cloud security OR (data OR mobile) NOT\n"x y" storage* growth',
+                 'cloud security OR (data OR mobile)\n\nNOT\n"x y" storage* growth',
+                 'cloud OR OR data', 'cloud OR (data', 'cloud NOT', 'cloud NOT x', '', 'NOT (a b) c']
+        for pattern in edits:
+            try:
+                self.assertSameTree(parser, pattern)
+            except ParseException as e:
+                self.assertRaises(ParseException, make_parse_tree, pattern)
+        self.assertTrue(first.matches('cloud'))
+
+    def test_reuse(self):
+        parser = IncrementalParser()
+        before = parser.parse('(a OR b) c "d e"')
+        after = self.assertSameTree(parser, '(a OR b) c x "d e"')
+        self.assertTrue(after.parts[0] is before.parts[0])
+        self.assertEqual(after.parts[3].word.char, 13)
+        self.assertTrue(after.parts[3].term is before.parts[2].term)
+        self.assertSameTree(parser, tagstr('(a OR b) c x "d e"', lineno=2, char=5))
+
+    def test_groups(self):
+        parser = IncrementalParser()
+        before = parser.parse('x OR (a (b OR c) NOT (d e) f) OR y')
+        after = self.assertSameTree(parser, 'x OR (a (b OR c) g NOT (d e) f) OR y')
+        group, old = after.parts[0].parts[1], before.parts[0].parts[1]
+        self.assertTrue(group.parts[1] is old.parts[1])
+        self.assertEqual(group.parts[3].tree.parts[0].word.char, 24)
+        self.assertTrue(after.parts[0].parts[2].term is before.parts[0].parts[2].term)
+        # the ')' is gone, so the groups pair up differently
+        self.assertRaises(ParseException, parser.parse, 'x OR (a (b OR c g NOT (d e) f) OR y')
+        self.assertSameTree(parser, 'x OR (a (b OR c g NOT (d e) f) OR y)')
+        self.assertSameTree(parser, 'x OR (a (b OR c g NOT (d\ne) f) OR y)')
+        self.assertSameTree(parser, 'x OR (a (b OR c g NOT (d\ne) f) OR y) z')
+        self.assertSameTree(parser, 'x OR (a (b OR c g NOT (d\ne) f) OR "y)" )')
+
+
 if __name__ == "__main__":
     unittest.main()